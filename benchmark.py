@@ -0,0 +1,444 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import timeit
+from typing import Any, Callable, Dict, List
+
+import dhtexporter
+
+# Tables read by the exporter, as created by the DHT App
+DHT_SCHEMA = """
+CREATE TABLE users (
+    id           INTEGER PRIMARY KEY NOT NULL,
+    name         TEXT NOT NULL,
+    avatar_url   TEXT,
+    discriminator TEXT,
+    display_name TEXT
+);
+CREATE TABLE servers (
+    id        INTEGER PRIMARY KEY NOT NULL,
+    name      TEXT NOT NULL,
+    type      TEXT NOT NULL,
+    icon_hash TEXT
+);
+CREATE TABLE channels (
+    id        INTEGER PRIMARY KEY NOT NULL,
+    server    INTEGER NOT NULL,
+    name      TEXT NOT NULL,
+    parent_id INTEGER,
+    position  INTEGER,
+    topic     TEXT,
+    nsfw      INTEGER
+);
+CREATE TABLE messages (
+    message_id INTEGER PRIMARY KEY NOT NULL,
+    sender_id  INTEGER NOT NULL,
+    channel_id INTEGER NOT NULL,
+    text       TEXT NOT NULL,
+    timestamp  INTEGER NOT NULL
+);
+CREATE TABLE attachments (
+    attachment_id  INTEGER PRIMARY KEY NOT NULL,
+    name           TEXT NOT NULL,
+    type           TEXT,
+    normalized_url TEXT NOT NULL,
+    download_url   TEXT,
+    size           INTEGER NOT NULL,
+    width          INTEGER,
+    height         INTEGER
+);
+CREATE TABLE message_attachments (
+    message_id    INTEGER NOT NULL,
+    attachment_id INTEGER NOT NULL,
+    PRIMARY KEY (message_id, attachment_id)
+);
+CREATE TABLE message_embeds (
+    message_id INTEGER NOT NULL,
+    json       TEXT NOT NULL
+);
+CREATE TABLE message_reactions (
+    message_id  INTEGER NOT NULL,
+    emoji_id    INTEGER,
+    emoji_name  TEXT,
+    emoji_flags INTEGER NOT NULL,
+    count       INTEGER NOT NULL
+);
+CREATE TABLE message_edit_timestamps (
+    message_id     INTEGER PRIMARY KEY NOT NULL,
+    edit_timestamp INTEGER NOT NULL
+);
+CREATE TABLE message_replied_to (
+    message_id    INTEGER PRIMARY KEY NOT NULL,
+    replied_to_id INTEGER NOT NULL
+);
+CREATE INDEX embeds_message_ix ON message_embeds(message_id);
+CREATE INDEX reactions_message_ix ON message_reactions(message_id);
+"""
+
+DISCORD_EPOCH = 1420070400000
+
+WORDS = (
+    "the be to of and a in that have it for not on with he as you do at this but his by from they we say her she or an "
+    "will my one all would there their what so up out if about who get which go me when make can like time no just him "
+    "know take people into year your good some could them see other than then now look only come its over think also "
+    "discord server channel message emoji lol yeah okay nice thanks **bold** *italic* `code` ||spoiler|| ünïcödé ✓ 👍"
+).split()
+
+REPEATED_EMBEDS = [
+    json.dumps({"url": f"https://example.com/post/{idx}", "type": "rich", "title": f"Bot notification {idx}", "description": "Posted again"})
+    for idx in range(20)
+]
+
+REACTIONS = [(None, "👍", 0), (None, "😂", 0), (None, "❤️", 0), (381234567890123456, "pepe", 0), (381234567890123457, "dance", 1)]
+
+def parse_count(value: str) -> int:
+    """Parse a count such as 10000, 10k or 10M."""
+    multiplier = {"k": 1000, "m": 1000000}.get(value[-1:].lower(), 1)
+    try:
+        return int(float(value[:-1] if multiplier > 1 else value) * multiplier)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid count: '{value}'")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmarks for dhtexporter.py')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    encode = subparsers.add_parser('encode', help='Compare per-message encode time of the installed JSON backends')
+    encode.add_argument('sqlite_file', nargs='?', help='DHT database to sample messages from (synthetic messages if omitted)')
+    encode.add_argument('--messages', type=int, default=20000, help='Number of messages to encode')
+    encode.add_argument('--repeat', type=int, default=5, help='Number of timed runs, the best one is reported')
+
+    connection = subparsers.add_parser('connection', help='Compare export times with the tuned and default connection profiles')
+    connection.add_argument('sqlite_file', help='DHT database to export')
+    connection.add_argument('--order', choices=list(dhtexporter.MERGE_KEYS), default='timestamp', help='Message order to export in')
+    connection.add_argument('--repeat', type=int, default=3, help='Number of timed runs, the best one is reported')
+
+    generate = subparsers.add_parser('generate', help='Generate a synthetic DHT database')
+    generate.add_argument('sqlite_file', help='Path of the database to create')
+    generate.add_argument('--messages', type=parse_count, default=10000, help='Number of messages, such as 10k or 10M')
+    generate.add_argument('--users', type=int, default=200, help='Number of users')
+    generate.add_argument('--servers', type=int, default=5, help='Number of servers, each with a share of the channels')
+    generate.add_argument('--channels', type=int, default=50, help='Number of channels')
+    generate.add_argument('--reply-density', type=float, default=0.15, help='Fraction of messages that reply to another message')
+    generate.add_argument('--attachment-density', type=float, default=0.1, help='Fraction of messages with attachments')
+    generate.add_argument('--embed-density', type=float, default=0.08, help='Fraction of messages with embeds')
+    generate.add_argument('--reaction-density', type=float, default=0.05, help='Fraction of messages with reactions')
+    generate.add_argument('--edit-density', type=float, default=0.03, help='Fraction of edited messages')
+    generate.add_argument('--seed', type=int, default=1, help='Random seed, the same options and seed produce the same database')
+    generate.add_argument('--force', action='store_true', help='Overwrite the database if it exists')
+
+    export = subparsers.add_parser('export', help='Time the metadata, messages and HTML writing stages of an export')
+    export.add_argument('sqlite_file', help='DHT database to export')
+    export.add_argument('--order', choices=list(dhtexporter.MERGE_KEYS), default='timestamp', help='Message order to export in')
+    export.add_argument('--workers', type=int, default=0, help='Number of worker processes (0 to disable)')
+    export.add_argument('--window', type=int, default=10000, help='Rows fetched per cursor at a time')
+    export.add_argument('--json-backend', choices=['auto', *dhtexporter.JSON_BACKENDS], default='auto', help='JSON encoder to use')
+    export.add_argument('--connection', choices=['tuned', 'default'], default='tuned', help='Database connection profile')
+    export.add_argument('--repeat', type=int, default=3, help='Number of timed runs, the best time of each stage is reported')
+    export.add_argument('--output', help='Save the results to a JSON file')
+    export.add_argument('--baseline', help='Compare against results saved by a previous run')
+
+    args = parser.parse_args()
+    if args.command == 'export' and args.window < 1:
+        export.error("--window must be at least 1")
+    return args
+
+def sample_messages(db_path: str, count: int) -> List[Dict[str, Any]]:
+    """Assemble the first messages of a database into viewer message objects."""
+    conn = dhtexporter.connect(db_path)
+    messages = []
+    for row, parts in dhtexporter.assemble_messages(conn, "id"):
+        messages.append(dhtexporter.build_assembled_message(row, parts))
+        if len(messages) == count:
+            break
+    conn.close()
+    return messages
+
+def synthetic_messages(count: int) -> List[Dict[str, Any]]:
+    """Build viewer message objects with a typical mix of optional fields."""
+    messages = []
+    for idx in range(count):
+        message_id = 1100000000000000000 + idx * 4194304
+        message = {
+            "id": str(message_id),
+            "c": "1000000000000000001",
+            "u": str(1000000000000000100 + idx % 50),
+            "t": 1600000000000 + idx * 1000,
+            "m": f"Message number {idx} with some **formatting**, a link https://example.com/{idx} and ünïcödé ✓"
+        }
+        if idx % 5 == 0:
+            message["a"] = [{"url": f"https://cdn.discordapp.com/attachments/1/{idx}/image.png", "name": "image.png", "width": 640, "height": 480}]
+        if idx % 7 == 0:
+            message["e"] = ['{"url":"https://example.com","type":"link","title":"Example Domain"}']
+        if idx % 11 == 0:
+            message["re"] = [{"n": "👍", "a": False, "c": 3}]
+        if idx % 3 == 0:
+            message["r"] = str(message_id - 4194304)
+        messages.append(message)
+    return messages
+
+def benchmark_encode(args):
+    messages = sample_messages(args.sqlite_file, args.messages) if args.sqlite_file else synthetic_messages(args.messages)
+    if not messages:
+        print("No messages to encode")
+        return
+
+    results = {}
+    for backend, module in dhtexporter.JSON_BACKENDS.items():
+        if module is not None:
+            dhtexporter.set_json_backend(backend)
+            encode = dhtexporter.encode_message
+            best = min(timeit.repeat(lambda: [encode(message) for message in messages], number=1, repeat=args.repeat))
+            results[backend] = best / len(messages) * 1e6
+
+    print(f"Encoded {len(messages)} messages, best of {args.repeat} runs")
+    for backend in dhtexporter.JSON_BACKENDS:
+        if backend in results:
+            print(f"{backend:>8}: {results[backend]:.2f} us/message ({results['json'] / results[backend]:.2f}x)")
+        else:
+            print(f"{backend:>8}: not installed")
+
+def time_export(db_path: str, order: str) -> float:
+    """Time fetching metadata and generating every message line, with progress output discarded."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        dhtexporter.fetch_metadata(db_path)
+        for _ in dhtexporter.generate_messages_ndjson(db_path, order=order):
+            pass
+        elapsed = time.perf_counter() - start
+        dhtexporter.close_db_connections()
+    return elapsed
+
+def benchmark_connection(args):
+    results = {}
+    for profile in ('default', 'tuned'):
+        dhtexporter.set_connection_profile(profile)
+        results[profile] = min(time_export(args.sqlite_file, args.order) for _ in range(args.repeat))
+
+    print(f"Exported {args.sqlite_file} ordered by {args.order}, best of {args.repeat} runs")
+    for profile, elapsed in results.items():
+        print(f"{profile:>8}: {elapsed:.2f} s ({results['default'] / elapsed:.2f}x)")
+
+def snowflake(timestamp: int, sequence: int) -> int:
+    """Build a Discord snowflake id for a timestamp."""
+    return ((timestamp - DISCORD_EPOCH) << 22) | (sequence & 0x3FFFFF)
+
+def generate_database(args):
+    if os.path.exists(args.sqlite_file):
+        if not args.force:
+            sys.exit(f"{args.sqlite_file} already exists, use --force to overwrite it")
+        os.remove(args.sqlite_file)
+
+    rng = random.Random(args.seed)
+    conn = sqlite3.connect(args.sqlite_file)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.executescript(DHT_SCHEMA)
+
+    user_ids = [snowflake(DISCORD_EPOCH + idx * 86400000, idx) for idx in range(1, args.users + 1)]
+    conn.executemany("INSERT INTO users VALUES (?, ?, ?, ?, ?)", [
+        (user_id, f"user{idx}", f"{rng.getrandbits(128):032x}" if rng.random() < 0.8 else None, None,
+         f"User {idx}" if rng.random() < 0.5 else None)
+        for idx, user_id in enumerate(user_ids)
+    ])
+
+    server_types = ["SERVER", "GROUP", "DM"]
+    server_ids = [snowflake(DISCORD_EPOCH + idx * 3600000, idx) for idx in range(1, args.servers + 1)]
+    conn.executemany("INSERT INTO servers VALUES (?, ?, ?, ?)", [
+        (server_id, f"Server {idx}", server_types[idx % len(server_types)], f"{rng.getrandbits(128):032x}" if idx % 2 else None)
+        for idx, server_id in enumerate(server_ids)
+    ])
+
+    channel_ids = [snowflake(DISCORD_EPOCH + idx * 60000, idx) for idx in range(1, args.channels + 1)]
+    conn.executemany("INSERT INTO channels VALUES (?, ?, ?, ?, ?, ?, ?)", [
+        (channel_id, server_ids[idx % len(server_ids)], f"channel-{idx}", None, idx, None, 0)
+        for idx, channel_id in enumerate(channel_ids)
+    ])
+
+    # Messages are spread over roughly five years, in batches so memory stays flat at any size
+    timestamp = 1500000000000
+    interval = max(1, 5 * 365 * 86400000 // max(1, args.messages))
+    recent_ids = []
+    attachment_id = 0
+    batch_size = 50000
+
+    print(f"Generating {args.messages} messages...", end="", flush=True)
+    for batch_start in range(0, args.messages, batch_size):
+        messages, attachments, message_attachments, embeds, reactions, edits, replies = [], [], [], [], [], [], []
+
+        for idx in range(batch_start, min(args.messages, batch_start + batch_size)):
+            timestamp += rng.randint(1, 2 * interval)
+            message_id = snowflake(timestamp, idx)
+            channel_id = channel_ids[int(rng.paretovariate(1.2)) % len(channel_ids)]
+            text = " ".join(rng.choices(WORDS, k=rng.randint(1, 30))) if rng.random() < 0.9 else ""
+            messages.append((message_id, rng.choice(user_ids), channel_id, text, timestamp))
+
+            if rng.random() < args.attachment_density:
+                for _ in range(rng.choice((1, 1, 1, 2, 3))):
+                    attachment_id += 1
+                    name = f"image_{attachment_id}.png" if rng.random() < 0.7 else f"file_{attachment_id}.zip"
+                    url = f"https://cdn.discordapp.com/attachments/{channel_id}/{snowflake(timestamp, attachment_id)}/{name}"
+                    has_size = name.endswith(".png")
+                    attachments.append((attachment_id, name, None, url, url, rng.randint(1000, 10000000),
+                                        rng.randint(100, 1920) if has_size else None, rng.randint(100, 1080) if has_size else None))
+                    message_attachments.append((message_id, attachment_id))
+
+            if rng.random() < args.embed_density:
+                if rng.random() < 0.5:
+                    embeds.append((message_id, rng.choice(REPEATED_EMBEDS)))
+                else:
+                    embeds.append((message_id, json.dumps({"url": f"https://example.com/{message_id}", "type": "link", "title": f"Link {idx}"})))
+
+            if rng.random() < args.reaction_density:
+                for emoji_id, emoji_name, emoji_flags in rng.sample(REACTIONS, rng.randint(1, 3)):
+                    reactions.append((message_id, emoji_id, emoji_name, emoji_flags, rng.randint(1, 20)))
+
+            if rng.random() < args.edit_density:
+                edits.append((message_id, timestamp + rng.randint(1000, 3600000)))
+
+            if recent_ids and rng.random() < args.reply_density:
+                # Mostly recent messages, sometimes one that is not in the database
+                replied_to_id = rng.choice(recent_ids) if rng.random() < 0.95 else snowflake(timestamp - 1000, 0)
+                replies.append((message_id, replied_to_id))
+
+            recent_ids.append(message_id)
+            if len(recent_ids) > 1000:
+                del recent_ids[:500]
+
+        conn.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?)", messages)
+        conn.executemany("INSERT INTO attachments VALUES (?, ?, ?, ?, ?, ?, ?, ?)", attachments)
+        conn.executemany("INSERT INTO message_attachments VALUES (?, ?)", message_attachments)
+        conn.executemany("INSERT INTO message_embeds VALUES (?, ?)", embeds)
+        conn.executemany("INSERT INTO message_reactions VALUES (?, ?, ?, ?, ?)", reactions)
+        conn.executemany("INSERT INTO message_edit_timestamps VALUES (?, ?)", edits)
+        conn.executemany("INSERT INTO message_replied_to VALUES (?, ?)", replies)
+        print(f"\rGenerating {args.messages} messages... {min(args.messages, batch_start + batch_size)}", end="", flush=True)
+
+    conn.commit()
+    conn.close()
+    print(f"\rGenerated {args.messages} messages in {args.sqlite_file} ({os.path.getsize(args.sqlite_file) / 1048576:.1f} MiB)")
+
+def time_stage(stage: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+    """Run an export stage, returning its wall and CPU time along with the stats it returns."""
+    start, start_cpu = time.perf_counter(), time.process_time()
+    stats = stage()
+    return {"seconds": time.perf_counter() - start, "cpu_seconds": time.process_time() - start_cpu, **stats}
+
+def run_export_stages(args) -> Dict[str, Dict[str, Any]]:
+    """Run one export, timing metadata, message generation and HTML writing separately.
+
+    Messages are spooled to a temporary file, so writing the HTML file can be timed
+    without generating them again.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        spool_path = os.path.join(temp_dir, "messages.ndjson")
+        html_path = os.path.join(temp_dir, "export.html")
+        metadata = {}
+
+        def fetch_metadata():
+            metadata["json"] = dhtexporter.encode_metadata(dhtexporter.fetch_metadata(args.sqlite_file))
+            dhtexporter.close_db_connections()
+            return {"bytes": len(metadata["json"].encode("utf-8"))}
+
+        def generate_messages():
+            count = 0
+            with open(spool_path, "w", encoding="utf-8") as spool:
+                for line in dhtexporter.generate_messages_ndjson(args.sqlite_file, order=args.order, window=args.window,
+                                                                 num_workers=args.workers):
+                    spool.write(line)
+                    spool.write("\n")
+                    count += 1
+            return {"messages": count}
+
+        def write_html():
+            with open(spool_path, "r", encoding="utf-8") as spool:
+                dhtexporter.write_html(html_path, dhtexporter.template_sections(
+                    [metadata["json"]], dhtexporter.join_lines(line.rstrip("\n") for line in spool)))
+            return {"bytes": os.path.getsize(html_path)}
+
+        return {
+            "fetch_metadata": time_stage(fetch_metadata),
+            "generate_messages_ndjson": time_stage(generate_messages),
+            "write_html": time_stage(write_html)
+        }
+
+def benchmark_export(args):
+    dhtexporter.set_progress_quiet(True)
+    dhtexporter.set_connection_profile(args.connection)
+    backend = dhtexporter.set_json_backend(args.json_backend)
+
+    runs = [run_export_stages(args) for _ in range(args.repeat)]
+    stages = {name: min((run[name] for run in runs), key=lambda stage: stage["seconds"]) for name in runs[0]}
+
+    messages = stages["generate_messages_ndjson"]["messages"]
+    stages["generate_messages_ndjson"]["messages_per_second"] = messages / stages["generate_messages_ndjson"]["seconds"]
+
+    results = {
+        "database": os.path.abspath(args.sqlite_file),
+        "database_bytes": os.path.getsize(args.sqlite_file),
+        "messages": messages,
+        "options": {
+            "order": args.order,
+            "workers": args.workers,
+            "window": args.window,
+            "json_backend": backend,
+            "connection": args.connection,
+            "repeat": args.repeat
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count()
+        },
+        "stages": stages,
+        "total_seconds": sum(stage["seconds"] for stage in stages.values())
+    }
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        # Runs with other options, such as another order or number of workers, do not time the same work
+        differences = [f"{name} {value} (now {results['options'].get(name)})"
+                       for name, value in baseline.get("options", {}).items()
+                       if name != "repeat" and results["options"].get(name) != value]
+        if differences:
+            print(f"Warning: the baseline was run with different options: {', '.join(differences)}", file=sys.stderr)
+
+    print(f"Exported {messages} messages from {args.sqlite_file}, best of {args.repeat} runs")
+    for name, stage in [*stages.items(), ("total", {"seconds": results["total_seconds"]})]:
+        line = f"{name:>26}: {stage['seconds']:8.3f} s"
+        if baseline:
+            previous = baseline["total_seconds"] if name == "total" else baseline["stages"].get(name, {}).get("seconds")
+            if previous:
+                line += f"  (baseline {previous:.3f} s, {stage['seconds'] / previous - 1:+.1%})"
+        print(line)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved results to {args.output}")
+
+def main():
+    args = parse_args()
+
+    if args.command == 'encode':
+        benchmark_encode(args)
+    elif args.command == 'connection':
+        benchmark_connection(args)
+    elif args.command == 'generate':
+        generate_database(args)
+    elif args.command == 'export':
+        benchmark_export(args)
+
+if __name__ == '__main__':
+    main()
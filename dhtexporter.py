@@ -3,17 +3,232 @@ import json
 import argparse
 import os
 import sys
-from typing import Dict, Any, Generator, List, Optional
-from concurrent.futures import ThreadPoolExecutor
+import re
+from typing import Dict, Any, Callable, Generator, Iterable, Iterator, List, Optional, Set, TextIO, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import threading
+import itertools
+import contextlib
+import collections
+import pathlib
+import hashlib
+import heapq
+import datetime
+import time
+import cProfile
+import pstats
+import tracemalloc
+import zlib
+import base64
+import array
+import secrets
+import http.server
+import urllib.parse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# JSON encoders, by preference. Optional ones are None when not installed.
+JSON_BACKENDS = {
+    "orjson": orjson,
+    "ujson": ujson,
+    "json": json
+}
+
+# Name of the selected JSON backend, its encoders and its decoder
+json_backend = "json"
+encode_message: Callable[[Any], str] = lambda obj: json.dumps(obj, ensure_ascii=False)
+encode_metadata: Callable[[Any], str] = lambda obj: json.dumps(obj, indent=2)
+decode_message: Callable[[str], Any] = json.loads
+
+def set_json_backend(backend: str = "auto") -> str:
+    """Select the JSON backend used to encode messages and metadata, returning its name."""
+    global json_backend, encode_message, encode_metadata, decode_message
+
+    if backend == "auto":
+        backend = next(name for name, module in JSON_BACKENDS.items() if module is not None)
+
+    if backend == "orjson":
+        encode_message = lambda obj: orjson.dumps(obj).decode("utf-8")
+        encode_metadata = lambda obj: orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode("utf-8")
+        decode_message = orjson.loads
+    elif backend == "ujson":
+        encode_message = lambda obj: ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False)
+        encode_metadata = lambda obj: ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False, indent=2)
+        decode_message = ujson.loads
+    else:
+        encode_message = lambda obj: json.dumps(obj, ensure_ascii=False)
+        encode_metadata = lambda obj: json.dumps(obj, indent=2)
+        decode_message = json.loads
+
+    json_backend = backend
+    return backend
+
+def parse_time(value: str) -> int:
+    """Parse a Unix timestamp in milliseconds, or an ISO 8601 date or datetime (local time unless it has an offset)."""
+    if value.isdigit():
+        return int(value)
+    try:
+        return int(datetime.datetime.fromisoformat(value).timestamp() * 1000)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date or timestamp: '{value}'")
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Parse Discord History Tracker data to a local HTML file')
     parser.add_argument('sqlite_file', help='Path to DHT SQLite database file')
     parser.add_argument('--outdir', help='Output directory for HTML file', default='.')
     parser.add_argument('--dump-json', action='store_true', help='Dump JSON files separately (debug)')
-    parser.add_argument('--threads', type=int, default=4, help='Number of threads to use for processing')
-    return parser.parse_args()
+    parser.add_argument('--threads', type=int, default=4, help='Number of threads to use for processing (query assembly only)')
+    parser.add_argument('--assembly', choices=['bulk', 'query'], default='bulk',
+                        help='Read side tables in one ordered scan each (bulk) or with per-message queries (query)')
+    parser.add_argument('--stream', action='store_true',
+                        help='Stream messages in message id order and write them out as they are assembled (constant memory)')
+    parser.add_argument('--window', type=int, default=10000, help='Rows fetched per cursor at a time when assembling messages')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Number of worker processes that assemble and encode chunks of --window messages (0 to disable)')
+    parser.add_argument('--json-backend', choices=['auto', *JSON_BACKENDS], default='auto',
+                        help='JSON encoder to use, auto picks the fastest one installed')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Keep a message store and manifest next to the HTML file and only read new or edited messages on later runs')
+    parser.add_argument('--shard', action='store_true',
+                        help='Write messages to one data file per channel, loaded by the HTML file when the channel is opened')
+    parser.add_argument('--lazy-channels', action='store_true',
+                        help='Embed the messages of each channel in a separate block, decoded when the channel is first opened')
+    parser.add_argument('--lazy-budget', type=int, default=250000,
+                        help='Messages of lazily decoded channels the viewer keeps before dropping the least recently opened ones')
+    parser.add_argument('--server', type=int, action='append', help='Only export messages from this server (repeatable)')
+    parser.add_argument('--channel', type=int, action='append', help='Only export messages from this channel (repeatable)')
+    parser.add_argument('--user', type=int, action='append', help='Only export messages sent by this user (repeatable)')
+    parser.add_argument('--since', type=parse_time, help='Only export messages sent at or after this date, datetime or millisecond timestamp')
+    parser.add_argument('--until', type=parse_time, help='Only export messages sent before this date, datetime or millisecond timestamp')
+    parser.add_argument('--connection', choices=['tuned', 'default'], default='tuned',
+                        help='Open the database read-only with memory-mapped I/O and a larger cache (tuned) or with SQLite defaults')
+    parser.add_argument('--quiet', action='store_true', help='Do not print progress or any other messages, only errors')
+    parser.add_argument('--payload', choices=['ndjson', 'channels', 'columnar'], default='ndjson',
+                        help='Embed messages as one JSON object per message (ndjson), grouped by channel in id order (channels) '
+                             'or as per channel arrays of each field (columnar)')
+    parser.add_argument('--resolve-replies', action='store_true',
+                        help='Embed the channel, author and a preview of replied to messages, also for messages outside the export')
+    parser.add_argument('--intern-strings', action='store_true',
+                        help='Store embeds and attachment URLs used by several messages once, in a table the messages refer to')
+    parser.add_argument('--search-index', action='store_true',
+                        help='Embed an inverted index of message text, which the contents filter looks up instead of scanning every message')
+    parser.add_argument('--fts', action='store_true',
+                        help='Also write a full-text search database of message text, attachment names and embeds to <name>.fts.sqlite, '
+                             'searched with: dhtexporter.py search')
+    parser.add_argument('--compress', choices=list(COMPRESSION_WBITS),
+                        help='Compress the embedded metadata and messages, the viewer decompresses them with DecompressionStream')
+    parser.add_argument('--profile', action='store_true',
+                        help='Time each export stage and save a report to <name>.profile.json next to the HTML file')
+    parser.add_argument('--profile-capture', choices=['cprofile', 'tracemalloc'], action='append',
+                        help='Also capture a cProfile profile or tracemalloc memory usage in the report, implies --profile (repeatable)')
+    args = parser.parse_args()
+
+    if args.profile_capture:
+        args.profile = True
+
+    if args.window < 1:
+        parser.error("--window must be at least 1")
+    if args.incremental and args.assembly == 'query':
+        parser.error("--incremental requires --assembly bulk")
+    if args.incremental and args.shard:
+        parser.error("--incremental cannot be combined with --shard")
+    if args.shard and args.assembly == 'query':
+        parser.error("--shard requires --assembly bulk")
+    if args.payload != 'ndjson' and args.assembly == 'query':
+        parser.error(f"--payload {args.payload} requires --assembly bulk")
+    if args.payload != 'ndjson' and (args.incremental or args.shard):
+        parser.error(f"--payload {args.payload} cannot be combined with --incremental or --shard")
+    if args.lazy_channels and args.assembly == 'query':
+        parser.error("--lazy-channels requires --assembly bulk")
+    if args.lazy_channels and (args.incremental or args.shard):
+        parser.error("--lazy-channels cannot be combined with --incremental or --shard")
+    if args.intern_strings and args.incremental:
+        parser.error("--intern-strings cannot be combined with --incremental")
+    if args.resolve_replies and args.incremental:
+        parser.error("--resolve-replies cannot be combined with --incremental")
+
+    if args.json_backend != 'auto' and JSON_BACKENDS[args.json_backend] is None:
+        parser.error(f"JSON backend '{args.json_backend}' is not installed")
+
+    return args
+
+def build_message_filter(args) -> Tuple[str, tuple]:
+    """Build the condition and params selecting the messages to export from the filter arguments."""
+    conditions = []
+    params = []
+
+    def add_condition(condition: str, *values):
+        conditions.append(condition)
+        params.extend(values)
+
+    def placeholders(values: List[int]) -> str:
+        return ", ".join("?" * len(values))
+
+    if args.server:
+        add_condition(f"channel_id IN (SELECT id FROM channels WHERE server IN ({placeholders(args.server)}))", *args.server)
+    if args.channel:
+        add_condition(f"channel_id IN ({placeholders(args.channel)})", *args.channel)
+    if args.user:
+        add_condition(f"sender_id IN ({placeholders(args.user)})", *args.user)
+    if args.since is not None:
+        add_condition("timestamp >= ?", args.since)
+    if args.until is not None:
+        add_condition("timestamp < ?", args.until)
+
+    return and_where(*conditions), tuple(params)
+
+# Pragmas of the tuned connection profile, which opens the database read-only
+# and lets SQLite use more memory for reading and sorting
+TUNED_CONNECTION_PRAGMAS = {
+    "mmap_size": 1 << 30,    # 1 GiB
+    "cache_size": -65536,    # 64 MiB
+    "temp_store": "MEMORY",
+    "query_only": 1
+}
+
+# Pragmas of the serve connection profile, the tuned one without in-memory temporary
+# storage, so the sorts of every viewer request spill to disk instead of filling memory
+SERVE_CONNECTION_PRAGMAS = {pragma: value for pragma, value in TUNED_CONNECTION_PRAGMAS.items() if pragma != "temp_store"}
+
+CONNECTION_PRAGMAS = {
+    "tuned": TUNED_CONNECTION_PRAGMAS,
+    "serve": SERVE_CONNECTION_PRAGMAS
+}
+
+# Selected connection profile, either "tuned", "serve" or "default"
+connection_profile = "tuned"
+
+def connect(db_path: str) -> sqlite3.Connection:
+    """Open a database connection using the selected connection profile.
+
+    The tuned and serve profiles also mark the database immutable, unless it has a write-ahead
+    log with changes that were not checkpointed yet, which immutable mode would skip.
+    """
+    if connection_profile == "default":
+        return sqlite3.connect(db_path)
+
+    uri = pathlib.Path(db_path).absolute().as_uri() + "?mode=ro"
+    wal_path = db_path + "-wal"
+    if not os.path.exists(wal_path) or os.path.getsize(wal_path) == 0:
+        uri += "&immutable=1"
+
+    conn = sqlite3.connect(uri, uri=True)
+    for pragma, value in CONNECTION_PRAGMAS[connection_profile].items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    return conn
+
+def set_connection_profile(profile: str):
+    """Select the connection profile used by connect()."""
+    global connection_profile
+    connection_profile = profile
 
 # Thread-local storage for database connections
 thread_local = threading.local()
@@ -21,7 +236,7 @@ thread_local = threading.local()
 def get_db_connection(db_path: str) -> sqlite3.Connection:
     """Get a thread-local database connection."""
     if not hasattr(thread_local, "connection"):
-        thread_local.connection = sqlite3.connect(db_path)
+        thread_local.connection = connect(db_path)
     return thread_local.connection
 
 def close_db_connections():
@@ -30,9 +245,221 @@ def close_db_connections():
         thread_local.connection.close()
         del thread_local.connection
 
+# Progress reporting: message generators count finished messages from the thread
+# that consumes them, and a reporter thread renders the count at a fixed rate, so
+# the hot path never prints or takes a lock.
+PROGRESS_REFRESH_INTERVAL = 0.25
+
+progress_quiet = False
+progress_stage = {"name": "", "done": 0, "total": 0, "start": 0.0, "width": 0}
+progress_stop = threading.Event()
+progress_thread: Optional[threading.Thread] = None
+
+def log(*values, **kwargs):
+    """Print a message, unless quiet mode is on."""
+    if not progress_quiet:
+        print(*values, **kwargs)
+
+def set_progress_quiet(quiet: bool):
+    """Turn quiet mode on or off, which hides progress and all other messages."""
+    global progress_quiet
+    progress_quiet = quiet
+
+def format_duration(seconds: float) -> str:
+    """Format a duration as H:MM:SS."""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}"
+
+def format_progress() -> str:
+    """Format the progress of the current stage with its throughput and estimated time left."""
+    done, total = progress_stage["done"], progress_stage["total"]
+    elapsed = time.perf_counter() - progress_stage["start"]
+    rate = done / elapsed if elapsed > 0 else 0
+
+    text = f"{progress_stage['name']} {done} of {total}... {rate:,.0f}/s"
+    if 0 < rate and done < total:
+        text += f", ETA {format_duration((total - done) / rate)}"
+    return text
+
+def progress_reporter():
+    """Render the progress of the current stage until it ends."""
+    while not progress_stop.wait(PROGRESS_REFRESH_INTERVAL):
+        text = format_progress()
+        print("\r" + text.ljust(progress_stage["width"]), end="", flush=True)
+        progress_stage["width"] = len(text)
+
+def progress_begin(name: str, total: int):
+    """Start a stage that processes total items, with a reporter thread when writing to a terminal."""
+    global progress_thread
+    progress_stage.update(name=name, done=0, total=total, start=time.perf_counter(), width=0)
+
+    if not progress_quiet and sys.stdout.isatty():
+        progress_stop.clear()
+        progress_thread = threading.Thread(target=progress_reporter, daemon=True)
+        progress_thread.start()
+
+def progress_advance(count: int = 1):
+    """Count finished items of the current stage. Must only be called from a single thread."""
+    progress_stage["done"] += count
+
+def progress_end():
+    """End the current stage, printing its final count, duration and throughput."""
+    global progress_thread
+    if progress_thread is not None:
+        progress_stop.set()
+        progress_thread.join()
+        progress_thread = None
+        log("\r", end="")
+
+    elapsed = time.perf_counter() - progress_stage["start"]
+    rate = progress_stage["done"] / elapsed if elapsed > 0 else 0
+    text = (f"{progress_stage['name']} {progress_stage['done']} of {progress_stage['total']}... "
+            f"Done ({format_duration(elapsed)}, {rate:,.0f}/s)")
+    log(text.ljust(progress_stage["width"]))
+
+# Profiling: stages record their wall and CPU time, calls, rows and bytes. Time spent in
+# a stage nested inside another is only counted in the inner one, so the stages add up
+# to the total. Every thread nests its own stages and CPU time is counted per thread,
+# stages of the threads of --assembly query run in parallel so they can add up to more.
+# With profiling off the wrappers return what they were given unchanged.
+profile_stats: Optional[Dict[str, Dict[str, Any]]] = None
+profile_local = threading.local()
+profile_lock = threading.Lock()
+
+def set_profiling(enabled: bool):
+    """Turn stage profiling on or off, clearing the recorded stages."""
+    global profile_stats
+    profile_stats = {} if enabled else None
+    get_profile_stack().clear()
+
+def get_profile_stack() -> List[List[float]]:
+    """Get the stack of the stages the current thread is in, with the time of their nested stages."""
+    if not hasattr(profile_local, "stack"):
+        profile_local.stack = []
+    return profile_local.stack
+
+def profile_begin() -> Tuple[float, float]:
+    """Start timing a stage, returning its start wall and CPU time."""
+    get_profile_stack().append([0.0, 0.0])
+    return time.perf_counter(), time.thread_time()
+
+def profile_end(name: str, start: Tuple[float, float], rows: int = 0, size: int = 0):
+    """Stop timing a stage, adding its time without the time of nested stages to its totals."""
+    wall, cpu = time.perf_counter() - start[0], time.thread_time() - start[1]
+    profile_stack = get_profile_stack()
+    nested_wall, nested_cpu = profile_stack.pop()
+    if profile_stack:
+        profile_stack[-1][0] += wall
+        profile_stack[-1][1] += cpu
+
+    with profile_lock:
+        stats = profile_stats.get(name)
+        if stats is None:
+            stats = profile_stats[name] = {"seconds": 0.0, "cpu_seconds": 0.0, "calls": 0, "rows": 0, "bytes": 0}
+        stats["seconds"] += wall - nested_wall
+        stats["cpu_seconds"] += cpu - nested_cpu
+        stats["calls"] += 1
+        stats["rows"] += rows
+        stats["bytes"] += size
+
+@contextlib.contextmanager
+def profile_stage(name: str) -> Iterator[Dict[str, int]]:
+    """Time a block as a stage, yielding a dict its rows and bytes can be counted in."""
+    counts = {"rows": 0, "bytes": 0}
+    if profile_stats is None:
+        yield counts
+        return
+
+    # Memory peaks are only tracked for top level stages of the main thread, since other ones would reset them
+    track_peak = tracemalloc.is_tracing() and not get_profile_stack() and threading.current_thread() is threading.main_thread()
+    if track_peak:
+        tracemalloc.reset_peak()
+
+    start = profile_begin()
+    yield counts
+    profile_end(name, start, counts["rows"], counts["bytes"])
+
+    if track_peak:
+        stats = profile_stats[name]
+        stats["peak_memory"] = max(stats.get("peak_memory", 0), tracemalloc.get_traced_memory()[1])
+
+def profile_function(name: str, func: Callable, rows: Optional[Callable[[Any], int]] = None,
+                     size: Optional[Callable[[Any], int]] = None) -> Callable:
+    """Wrap a function so every call is timed as a stage, counting rows (one per call by default) and bytes of its result."""
+    if profile_stats is None:
+        return func
+
+    def timed(*args):
+        start = profile_begin()
+        result = func(*args)
+        profile_end(name, start, rows(result) if rows else 1, size(result) if size else 0)
+        return result
+    return timed
+
+def profile_iter(name: str, iterable: Iterable) -> Iterable:
+    """Wrap an iterable so the time spent producing each item is timed as a stage."""
+    if profile_stats is None:
+        return iterable
+
+    def timed():
+        iterator = iter(iterable)
+        while True:
+            start = profile_begin()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                profile_end(name, start, rows=0)
+                return
+            profile_end(name, start, rows=1)
+            yield item
+    return timed()
+
+def save_profile_report(report_path: str, start: Tuple[float, float], profiler: Optional[cProfile.Profile] = None):
+    """Save the recorded stages, with the cProfile functions and tracemalloc usage if captured, as a JSON report."""
+    wall, cpu = time.perf_counter() - start[0], time.process_time() - start[1]
+    report = {
+        "options": {name: value for name, value in vars(args).items() if not name.startswith("profile")},
+        "json_backend": json_backend,
+        "total": {"seconds": wall, "cpu_seconds": cpu},
+        "stages": profile_stats,
+        # Time not covered by any stage, such as argument parsing and logging
+        "other": {
+            "seconds": wall - sum(stats["seconds"] for stats in profile_stats.values()),
+            "cpu_seconds": cpu - sum(stats["cpu_seconds"] for stats in profile_stats.values())
+        }
+    }
+
+    if profiler is not None:
+        pstats_path = os.path.splitext(report_path)[0] + ".pstats"
+        profiler.dump_stats(pstats_path)
+        functions = pstats.Stats(profiler).stats
+        report["cprofile"] = {
+            "file": pstats_path,
+            "functions": [
+                {"function": f"{file}:{line}({function})", "calls": calls, "seconds": total_time, "cumulative_seconds": cumulative_time}
+                for (file, line, function), (_, calls, total_time, cumulative_time, _) in
+                sorted(functions.items(), key=lambda item: item[1][3], reverse=True)[:30]
+            ]
+        }
+
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        report["tracemalloc"] = {
+            "current": current,
+            "peak": peak,
+            "top": [
+                {"location": str(statistic.traceback), "size": statistic.size, "count": statistic.count}
+                for statistic in tracemalloc.take_snapshot().statistics("lineno")[:20]
+            ]
+        }
+
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
 def print_counts(db_path: str):
     """Print counts of servers, channels and messages."""
-    conn = sqlite3.connect(db_path)
+    conn = connect(db_path)
     cursor = conn.cursor()
 
     # Get server count
@@ -48,14 +475,30 @@ def print_counts(db_path: str):
     message_count = cursor.fetchone()[0]
 
     conn.close()
-    print(f"Servers: {server_count} - Channels: {channel_count} - Messages: {message_count}")
+    log(f"Servers: {server_count} - Channels: {channel_count} - Messages: {message_count}")
 
-def fetch_metadata(db_path: str) -> Dict[str, Any]:
-    """Fetch metadata from SQLite database and return as structured dictionary."""
-    print("Parsing metadata...", end="", flush=True)
+def fetch_metadata(db_path: str, where: str = "", params: tuple = (), reply_authors: bool = False) -> Dict[str, Any]:
+    """Fetch metadata from SQLite database and return as structured dictionary.
+
+    With a where condition, only users, channels and servers referenced by the messages
+    that match it are included, and with reply_authors also the authors of messages
+    they reply to.
+    """
+    log("Parsing metadata...", end="", flush=True)
     conn = get_db_connection(db_path)
     cursor = conn.cursor()
 
+    user_filter = server_filter = channel_filter = ""
+    user_params = params
+    if where:
+        user_filter = f" WHERE id IN (SELECT sender_id FROM messages WHERE {where})"
+        if reply_authors:
+            user_filter += (" OR id IN (SELECT t.sender_id FROM message_replied_to s"
+                            f" JOIN messages t ON t.message_id = s.replied_to_id{side_table_where(where)})")
+            user_params = params * 2
+        channel_filter = f" WHERE id IN (SELECT channel_id FROM messages WHERE {where})"
+        server_filter = f" WHERE id IN (SELECT server FROM channels{channel_filter})"
+
     metadata = {
         "users": {},
         "servers": {},
@@ -63,7 +506,7 @@ def fetch_metadata(db_path: str) -> Dict[str, Any]:
     }
 
     # Fetch users data
-    cursor.execute("SELECT id, name, display_name, avatar_url FROM users")
+    cursor.execute(f"SELECT id, name, display_name, avatar_url FROM users{user_filter}", user_params)
     for user_id, name, display_name, avatar_url in cursor.fetchall():
         user_data = {
             "name": name
@@ -75,7 +518,7 @@ def fetch_metadata(db_path: str) -> Dict[str, Any]:
         metadata["users"][str(user_id)] = user_data
 
     # Fetch servers data
-    cursor.execute("SELECT id, name, type, icon_hash FROM servers")
+    cursor.execute(f"SELECT id, name, type, icon_hash FROM servers{server_filter}", params)
     for server_id, name, server_type, icon_hash in cursor.fetchall():
         server_data = {
             "name": name,
@@ -88,34 +531,79 @@ def fetch_metadata(db_path: str) -> Dict[str, Any]:
             server_data["iconUrl"] = f"https://cdn.discordapp.com/{base_url}/{server_id}/{icon_hash}.webp"
         metadata["servers"][str(server_id)] = server_data
 
-    # Fetch channels data
-    cursor.execute("SELECT id, server, name FROM channels")
+    # Fetch channels data, with their message counts so the viewer does not have to count them
+    counts = fetch_channel_counts(db_path, where, params)
+    cursor.execute(f"SELECT id, server, name FROM channels{channel_filter}", params)
     for channel_id, server_id, name in cursor.fetchall():
         channel_data = {
             "server": str(server_id),
-            "name": name
+            "name": name,
+            "count": counts.get(str(channel_id), 0)
         }
         metadata["channels"][str(channel_id)] = channel_data
 
-    print("Done")
+    log("Done")
     return metadata
 
-def get_message_attachments(message_id: str) -> Optional[List[Dict]]:
-    """Fetch attachments for a specific message."""
-    conn = get_db_connection(args.sqlite_file)
+def fetch_channel_counts(db_path: str, where: str = "", params: tuple = ()) -> Dict[str, int]:
+    """Count the exported messages of each channel."""
+    conn = connect(db_path)
     cursor = conn.cursor()
+    cursor.execute(f"SELECT channel_id, COUNT(*) FROM messages{messages_where(where)} GROUP BY channel_id", params)
+    counts = {str(channel_id): count for channel_id, count in cursor.fetchall()}
+    conn.close()
+    return counts
 
-    cursor.execute("""
-        SELECT a.name, a.download_url, a.width, a.height
-        FROM message_attachments ma
-        JOIN attachments a ON ma.attachment_id = a.attachment_id
-        WHERE ma.message_id = ?
-    """, (message_id,))
+# Strings used by several messages, mapped to their index in the strings table of the
+# metadata. Messages refer to these by index instead of repeating them.
+interned_strings: Dict[str, int] = {}
+
+def set_interned_strings(strings: List[str]):
+    """Select the strings table that embeds and attachment URLs are replaced with references to."""
+    global interned_strings
+    interned_strings = {value: index for index, value in enumerate(strings)}
+
+def find_repeated_strings(db_path: str, where: str = "", params: tuple = ()) -> Tuple[List[str], int, int]:
+    """Find embeds and attachment URLs worth storing once, returning the strings table, how many
+    references replace them and the bytes saved.
+
+    Strings are ordered by use, so the most used ones get the shortest references, and
+    only kept if the references and table entry take less space than the copies.
+    """
+    conn = connect(db_path)
+    cursor = conn.cursor()
+
+    counts = collections.Counter()
+    cursor.execute(f"SELECT s.json, COUNT(*) FROM message_embeds s{side_table_where(where)} GROUP BY s.json HAVING COUNT(*) > 1", params)
+    counts.update(dict(cursor.fetchall()))
+    cursor.execute(f"""
+        SELECT a.download_url, COUNT(*)
+        FROM message_attachments s
+        JOIN attachments a ON s.attachment_id = a.attachment_id{side_table_where(where)}
+        GROUP BY a.download_url HAVING COUNT(*) > 1
+    """, params)
+    counts.update({url: count for url, count in cursor.fetchall() if url is not None})
+    conn.close()
 
+    strings = []
+    references = saved = 0
+    for value, count in counts.most_common():
+        size = len(encode_message(value).encode("utf-8"))
+        # Every copy becomes a reference, and the table gets the string and a separator
+        saving = count * (size - len(str(len(strings)))) - size - 1
+        if saving > 0:
+            strings.append(value)
+            references += count
+            saved += saving
+
+    return strings, references, saved
+
+def format_attachments(rows: List[tuple]) -> Optional[List[Dict]]:
+    """Convert (name, url, width, height) rows into attachment objects."""
     attachments = []
-    for name, url, width, height in cursor.fetchall():
+    for name, url, width, height in rows:
         attachment = {
-            "url": url,
+            "url": interned_strings.get(url, url),
             "name": name
         }
         if width and height:
@@ -127,6 +615,80 @@ def get_message_attachments(message_id: str) -> Optional[List[Dict]]:
 
     return attachments if attachments else None
 
+def format_reactions(rows: List[tuple]) -> Optional[List[Dict]]:
+    """Convert (emoji_id, emoji_name, emoji_flags, count) rows into reaction objects."""
+    reactions = []
+    for emoji_id, emoji_name, emoji_flags, count in rows:
+        reaction = {
+            "n": emoji_name,
+            "a": bool(emoji_flags),  # True if animated emoji
+            "c": count
+        }
+        if emoji_id:
+            reaction["id"] = str(emoji_id)
+        reactions.append(reaction)
+
+    return reactions if reactions else None
+
+# Length of the text preview of resolved replies
+REPLY_PREVIEW_LENGTH = 100
+
+# Whether replies embed the message they reply to, see format_reply()
+resolve_replies = False
+
+def set_reply_resolution(enabled: bool):
+    """Turn embedding replied to messages in replies on or off."""
+    global resolve_replies
+    resolve_replies = enabled
+
+# Columns and join of the replied to message in reply queries, the columns are NULL
+# when replies are not resolved so format_reply() always gets the same row shape
+REPLY_TARGET_COLUMNS = "t.channel_id, t.sender_id, t.text"
+REPLY_TARGET_JOIN = "\n        LEFT JOIN messages t ON t.message_id = {replied_to_id}"
+
+def reply_target(replied_to_id: str) -> Tuple[str, str]:
+    """Return the replied to message columns and join of reply queries."""
+    if not resolve_replies:
+        return "NULL, NULL, NULL", ""
+    return REPLY_TARGET_COLUMNS, REPLY_TARGET_JOIN.format(replied_to_id=replied_to_id)
+
+def format_reply(rows: List[tuple]) -> Optional[Union[str, Dict]]:
+    """Convert a (replied_to_id, channel_id, sender_id, text) row into a reply.
+
+    With reply resolution on, replies to messages in the database are objects with the
+    id, channel, author and a preview of the text of the message, otherwise (and for
+    messages that are not in the database) they are just the replied to message id.
+    """
+    if not rows:
+        return None
+
+    replied_to_id, channel_id, sender_id, text = rows[0]
+    if not resolve_replies or channel_id is None:
+        return str(replied_to_id)
+
+    reply = {
+        "id": str(replied_to_id),
+        "c": str(channel_id),
+        "u": str(sender_id)
+    }
+    if text:
+        reply["m"] = text if len(text) <= REPLY_PREVIEW_LENGTH else text[:REPLY_PREVIEW_LENGTH] + "…"
+    return reply
+
+def get_message_attachments(message_id: str) -> Optional[List[Dict]]:
+    """Fetch attachments for a specific message."""
+    conn = get_db_connection(args.sqlite_file)
+    cursor = conn.cursor()
+
+    cursor.execute("""
+        SELECT a.name, a.download_url, a.width, a.height
+        FROM message_attachments ma
+        JOIN attachments a ON ma.attachment_id = a.attachment_id
+        WHERE ma.message_id = ?
+    """, (message_id,))
+
+    return format_attachments(cursor.fetchall())
+
 def get_message_edit_timestamp(message_id: str) -> Optional[int]:
     """Fetch edit timestamp for a specific message."""
     conn = get_db_connection(args.sqlite_file)
@@ -156,46 +718,29 @@ def get_message_reactions(message_id: str) -> Optional[List[Dict]]:
         WHERE message_id = ?
     """, (message_id,))
 
-    reactions = []
-    for emoji_id, emoji_name, emoji_flags, count in cursor.fetchall():
-        reaction = {
-            "n": emoji_name,
-            "a": bool(emoji_flags),  # True if animated emoji
-            "c": count
-        }
-        if emoji_id:
-            reaction["id"] = str(emoji_id)
-        reactions.append(reaction)
+    return format_reactions(cursor.fetchall())
 
-    return reactions if reactions else None
-
-def get_message_reply(message_id: str) -> Optional[str]:
-    """Fetch replied-to message ID for a specific message."""
+def get_message_reply(message_id: str) -> Optional[Union[str, Dict]]:
+    """Fetch the reply of a specific message."""
     conn = get_db_connection(args.sqlite_file)
     cursor = conn.cursor()
 
-    cursor.execute("SELECT replied_to_id FROM message_replied_to WHERE message_id = ?", (message_id,))
-    result = cursor.fetchone()
-    return str(result[0]) if result else None
-
-def process_message(message_data: tuple) -> str:
-    """Process a single message into its final JSON format."""
-    message_id, sender_id, channel_id, text, timestamp, idx, total = message_data
-    message_id_str = str(message_id)
-
-    # Print progress
-    print(f"\rParsing messages {idx + 1} of {total}...", end="", flush=True)
+    columns, join = reply_target("mr.replied_to_id")
+    cursor.execute(f"""
+        SELECT mr.replied_to_id, {columns}
+        FROM message_replied_to mr{join}
+        WHERE mr.message_id = ?
+    """, (message_id,))
 
-    # Get all message components first
-    attachments = get_message_attachments(message_id_str)
-    embeds = get_message_embeds(message_id_str)
-    edit_timestamp = get_message_edit_timestamp(message_id_str)
-    reactions = get_message_reactions(message_id_str)
-    reply_to = get_message_reply(message_id_str)
+    return format_reply(cursor.fetchall())
 
+def build_message(message_id: int, sender_id: int, channel_id: int, text: str, timestamp: int,
+                  attachments: Optional[List[Dict]], embeds: Optional[List[str]], edit_timestamp: Optional[int],
+                  reactions: Optional[List[Dict]], reply_to: Optional[Union[str, Dict]]) -> Dict[str, Any]:
+    """Build the viewer message object from a message row and its side table data."""
     # Base message structure
     message_obj = {
-        "id": message_id_str,
+        "id": str(message_id),
         "c": str(channel_id),
         "u": str(sender_id),
         "t": timestamp
@@ -211,7 +756,7 @@ def process_message(message_data: tuple) -> str:
 
     # Add embeds if they exist
     if embeds:
-        message_obj["e"] = embeds
+        message_obj["e"] = [interned_strings.get(embed, embed) for embed in embeds] if interned_strings else embeds
 
     # Add edit timestamp if it exists
     if edit_timestamp:
@@ -225,39 +770,821 @@ def process_message(message_data: tuple) -> str:
     if reply_to:
         message_obj["r"] = reply_to
 
-    # All messages parsed, it's done
-    if idx + 1 == total:
-        print("Done")
+    return message_obj
+
+def get_message_parts(message_id: str) -> tuple:
+    """Fetch the attachments, embeds, edit timestamp, reactions and reply of a specific message."""
+    return (get_message_attachments(message_id), get_message_embeds(message_id), get_message_edit_timestamp(message_id),
+            get_message_reactions(message_id), get_message_reply(message_id))
 
-    return json.dumps(message_obj, ensure_ascii=False)
+def process_message(message_data: tuple) -> str:
+    """Process a single message into its final JSON format."""
+    message_id, sender_id, channel_id, text, timestamp = message_data
+    message_obj = build_message(message_id, sender_id, channel_id, text, timestamp, *get_message_parts(str(message_id)))
+    return encode_message(message_obj)
+
+# Bulk assembly: every side table is read once, in the same order as the messages
+# query, and merged into the message stream in a single pass.
+SIDE_TABLE_QUERIES = {
+    "attachments": """
+        SELECT {key}, a.name, a.download_url, a.width, a.height
+        FROM message_attachments s
+        JOIN attachments a ON s.attachment_id = a.attachment_id{join}{where}
+        ORDER BY {key}, s.attachment_id
+    """,
+    "embeds": """
+        SELECT {key}, s.json
+        FROM message_embeds s{join}{where}
+        ORDER BY {key}, s.rowid
+    """,
+    "edit_timestamp": """
+        SELECT {key}, s.edit_timestamp
+        FROM message_edit_timestamps s{join}{where}
+        ORDER BY {key}
+    """,
+    "reactions": """
+        SELECT {key}, s.emoji_id, s.emoji_name, s.emoji_flags, s.count
+        FROM message_reactions s{join}{where}
+        ORDER BY {key}, s.rowid
+    """,
+    "reply_to": """
+        SELECT {key}, s.replied_to_id, {reply_columns}
+        FROM message_replied_to s{join}{reply_join}{where}
+        ORDER BY {key}
+    """
+}
+
+# Keys the messages and side tables can be merged on: (side table key columns,
+# side table join, messages ordering, message row to key)
+MERGE_KEYS = {
+    # Same order as the original export, side tables are joined to messages and sorted
+    "timestamp": (
+        "m.timestamp, s.message_id",
+        "\n        JOIN messages m ON m.message_id = s.message_id",
+        "timestamp, message_id",
+        lambda row: (row[4], row[0])
+    ),
+    # Index order, side tables are streamed straight off their message_id indexes
+    "id": (
+        "s.message_id",
+        "",
+        "message_id",
+        lambda row: (row[0],)
+    ),
+    # Grouped by channel, side tables are joined to messages and sorted
+    "channel": (
+        "m.channel_id, s.message_id",
+        "\n        JOIN messages m ON m.message_id = s.message_id",
+        "channel_id, message_id",
+        lambda row: (row[2], row[0])
+    )
+}
+
+def side_table_query(query: str, key: str, join: str, where: str) -> str:
+    """Fill in a side table query, joining replied to messages only when replies are resolved."""
+    reply_columns, reply_join = reply_target("s.replied_to_id")
+    return query.format(key=key, join=join, where=where, reply_columns=reply_columns, reply_join=reply_join)
+
+def iter_rows(cursor: sqlite3.Cursor, window: int, stage: str = "") -> Iterator[tuple]:
+    """Iterate over the rows of an executed cursor, fetching at most window rows at a time.
+
+    With a stage name, fetches are timed as that stage when profiling.
+    """
+    fetch = profile_function(stage, cursor.fetchmany, rows=len) if stage else cursor.fetchmany
+    while True:
+        rows = fetch(window)
+        if not rows:
+            break
+        yield from rows
+
+def iter_side_table(cursor: sqlite3.Cursor, key_length: int, window: int, stage: str = "") -> Iterator[Tuple[tuple, List[tuple]]]:
+    """Yield the rows of an executed side table query grouped by merge key."""
+    for key, rows in itertools.groupby(iter_rows(cursor, window, stage), key=lambda row: row[:key_length]):
+        yield key, [row[key_length:] for row in rows]
+
+def and_where(*conditions: str) -> str:
+    """Combine conditions with AND, skipping empty ones."""
+    return " AND ".join(f"({condition})" for condition in conditions if condition)
+
+def messages_where(where: str) -> str:
+    """Return the WHERE clause selecting messages that match a condition, or nothing without one."""
+    return f" WHERE {where}" if where else ""
+
+def side_table_where(where: str) -> str:
+    """Return the WHERE clause selecting side table rows of messages that match a condition."""
+    return f"\n        WHERE s.message_id IN (SELECT message_id FROM messages WHERE {where})" if where else ""
+
+def count_messages(conn: sqlite3.Connection, where: str = "", params: tuple = ()) -> int:
+    """Count messages that match a condition."""
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT COUNT(*) FROM messages{messages_where(where)}", params)
+    return cursor.fetchone()[0]
+
+def assemble_messages(conn: sqlite3.Connection, merge_key: str = "timestamp", window: int = 10000,
+                      where: str = "", params: tuple = ()) -> Generator[Tuple[tuple, Dict[str, List[tuple]]], None, None]:
+    """Merge-join messages with their side table rows, yielding (message row, side rows by table).
+
+    An optional where condition with its params restricts the messages, and the side
+    table rows that are read, to a subset of the database.
+    """
+    key_columns, join, order, message_key = MERGE_KEYS[merge_key]
+    key_length = len(key_columns.split(","))
+
+    side_tables = {}
+    for name, query in SIDE_TABLE_QUERIES.items():
+        cursor = conn.cursor()
+        with profile_stage("side_tables"):
+            cursor.execute(side_table_query(query, key_columns, join, side_table_where(where)), params)
+        side_tables[name] = iter_side_table(cursor, key_length, window, "side_tables")
+    pending = {name: next(rows, None) for name, rows in side_tables.items()}
 
-def generate_messages_ndjson(db_path: str, num_threads: int = 4) -> Generator[str, None, None]:
-    """Generate x-ndjson formatted messages from SQLite database using threading."""
-    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    with profile_stage("message_query"):
+        cursor.execute(f"SELECT message_id, sender_id, channel_id, text, timestamp FROM messages{messages_where(where)} ORDER BY {order}", params)
+    for row in iter_rows(cursor, window, "message_query"):
+        key = message_key(row)
+        parts = {}
+        for name, rows in side_tables.items():
+            group = pending[name]
+            # Skip side table rows that reference missing messages
+            while group is not None and group[0] < key:
+                group = next(rows, None)
+            if group is not None and group[0] == key:
+                parts[name] = group[1]
+                group = next(rows, None)
+            pending[name] = group
+        yield row, parts
+
+def build_assembled_message(row: tuple, parts: Dict[str, List[tuple]]) -> Dict[str, Any]:
+    """Build the viewer message object from a message row merged with its side table rows."""
+    message_id, sender_id, channel_id, text, timestamp = row
+
+    embeds = parts.get("embeds")
+    edit_timestamp = parts.get("edit_timestamp")
+
+    return build_message(
+        message_id, sender_id, channel_id, text, timestamp,
+        format_attachments(parts.get("attachments", [])),
+        [embed for embed, in embeds] if embeds else None,
+        edit_timestamp[0][0] if edit_timestamp else None,
+        format_reactions(parts.get("reactions", [])),
+        format_reply(parts.get("reply_to", []))
+    )
+
+def process_assembled_message(row: tuple, parts: Dict[str, List[tuple]]) -> str:
+    """Process a message row merged with its side table rows into its final JSON format."""
+    return encode_message(build_assembled_message(row, parts))
+
+# Per-process database connection used by worker processes
+worker_connection = None
+
+def init_worker(db_path: str, backend: str, profile: str, strings: List[str], replies: bool):
+    """Open the database connection and select the JSON backend, strings table and reply resolution of a worker process."""
+    global worker_connection
+    set_connection_profile(profile)
+    worker_connection = connect(db_path)
+    set_json_backend(backend)
+    set_interned_strings(strings)
+    set_reply_resolution(replies)
+
+def process_message_chunk(rows: List[tuple], by_ids: bool = False) -> List[str]:
+    """Assemble and encode a chunk of message rows in a worker process, keeping their order.
+
+    Side table rows are read for the message id range covered by the chunk, or with
+    by_ids for the chunk's message ids, when its range spans messages of other chunks.
+    """
+    cursor = worker_connection.cursor()
+    message_ids = [row[0] for row in rows]
+    if by_ids:
+        # Message ids are integers read from the database, so they are inlined rather than bound
+        where = f"\n        WHERE s.message_id IN ({','.join(map(str, message_ids))})"
+        bounds = ()
+    else:
+        where = "\n        WHERE s.message_id BETWEEN ? AND ?"
+        bounds = (min(message_ids), max(message_ids))
+
+    side_tables = {}
+    for name, query in SIDE_TABLE_QUERIES.items():
+        cursor.execute(side_table_query(query, "s.message_id", "", where), bounds)
+        side_tables[name] = {
+            message_id: [row[1:] for row in side_rows]
+            for message_id, side_rows in itertools.groupby(cursor, key=lambda row: row[0])
+        }
+
+    return [
+        process_assembled_message(row, {name: table[row[0]] for name, table in side_tables.items() if row[0] in table})
+        for row in rows
+    ]
+
+def generate_messages_ndjson_workers(db_path: str, num_workers: int, order: str = "timestamp", window: int = 10000,
+                                     where: str = "", params: tuple = ()) -> Generator[str, None, None]:
+    """Generate x-ndjson formatted messages by encoding chunks of window messages in worker processes."""
+    conn = connect(db_path)
+    total_messages = count_messages(conn, where, params)
+
+    _, _, order_columns, _ = MERGE_KEYS[order]
+    cursor = conn.cursor()
+    with profile_stage("message_query"):
+        cursor.execute(f"SELECT message_id, sender_id, channel_id, text, timestamp FROM messages{messages_where(where)} ORDER BY {order_columns}", params)
+    fetch = profile_function("message_query", cursor.fetchmany, rows=len)
+
+    progress_begin("Parsing messages", total_messages)
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=init_worker, initargs=(db_path, json_backend, connection_profile, list(interned_strings), resolve_replies)) as executor:
+        # Keep a couple of chunks queued per worker, results are collected in submission order
+        pending = collections.deque()
+        while True:
+            rows = fetch(window)
+            if rows:
+                # Chunks of channel ordered messages cover most of the id range, so they look up their own ids
+                pending.append(executor.submit(process_message_chunk, rows, order == "channel"))
+            if pending and (not rows or len(pending) > num_workers * 2):
+                lines = pending.popleft().result()
+                progress_advance(len(lines))
+                yield from lines
+            elif not rows:
+                break
+
+    conn.close()
+    progress_end()
+
+def generate_messages_ndjson(db_path: str, num_threads: int = 4, assembly: str = "bulk",
+                             order: str = "timestamp", window: int = 10000, num_workers: int = 0,
+                             where: str = "", params: tuple = ()) -> Generator[str, None, None]:
+    """Generate x-ndjson formatted messages from SQLite database.
+
+    Messages are ordered by one of the MERGE_KEYS. Ordering by id needs no sorting at
+    all, so at most window rows per cursor are held in memory no matter the size.
+    """
+    if assembly == "query":
+        yield from generate_messages_ndjson_queries(db_path, num_threads, where, params)
+        return
+    if num_workers > 0:
+        yield from generate_messages_ndjson_workers(db_path, num_workers, order, window, where, params)
+        return
+
+    conn = connect(db_path)
+    total_messages = count_messages(conn, where, params)
+
+    # Same as process_assembled_message(), split so building and encoding can be profiled separately
+    build = profile_function("build_messages", build_assembled_message)
+    encode = profile_function("encode_messages", encode_message, size=lambda line: len(line.encode("utf-8")))
+
+    progress_begin("Parsing messages", total_messages)
+    for row, parts in assemble_messages(conn, order, window, where, params):
+        yield encode(build(row, parts))
+        progress_advance()
+
+    conn.close()
+    progress_end()
+
+def generate_messages_ndjson_queries(db_path: str, num_threads: int = 4,
+                                     where: str = "", params: tuple = ()) -> Generator[str, None, None]:
+    """Generate x-ndjson formatted messages using per-message queries and threading."""
+    conn = connect(db_path)
     cursor = conn.cursor()
 
     # Get all messages first for multithreading
-    cursor.execute("SELECT message_id, sender_id, channel_id, text, timestamp FROM messages ORDER BY timestamp")
-    all_messages = cursor.fetchall()
-    total_messages = len(all_messages)
+    with profile_stage("message_query") as stage:
+        cursor.execute(f"SELECT message_id, sender_id, channel_id, text, timestamp FROM messages{messages_where(where)} ORDER BY timestamp", params)
+        all_messages = cursor.fetchall()
+        stage["rows"] = len(all_messages)
     conn.close()
 
-    # Add index and total to each message for progress tracking
-    messages_with_progress = [(*msg, idx, total_messages) for idx, msg in enumerate(all_messages)]
+    # Same as process_message(), split so the lookups, building and encoding can be profiled separately
+    fetch = profile_function("side_tables", get_message_parts)
+    build = profile_function("build_messages", build_message)
+    encode = profile_function("encode_messages", encode_message, size=lambda line: len(line.encode("utf-8")))
 
-    # Process messages in parallel
+    def process(message_data: tuple) -> str:
+        message_id, sender_id, channel_id, text, timestamp = message_data
+        return encode(build(message_id, sender_id, channel_id, text, timestamp, *fetch(str(message_id))))
+
+    # Process messages in parallel, progress is counted as results come back in order
+    progress_begin("Parsing messages", len(all_messages))
     with ThreadPoolExecutor(max_workers=num_threads) as executor:
-        for result in executor.map(process_message, messages_with_progress):
+        for result in executor.map(process, all_messages):
             yield result
+            progress_advance()
 
     close_db_connections()
+    progress_end()
+
+# Incremental export: messages are retained in an NDJSON store ordered by message id,
+# and a manifest records what the store holds so the next run only reads what changed.
+MANIFEST_VERSION = 1
+
+# Start of every encoded message line, all JSON backends write the id and channel first
+MESSAGE_LINE_PREFIX = re.compile(r'\{"id":\s*"(\d+)",\s*"c":\s*"(\d+)"')
+
+def load_manifest(manifest_path: str) -> Optional[Dict[str, Any]]:
+    """Load the manifest of a previous export, if there is a usable one."""
+    if not os.path.exists(manifest_path):
+        return None
+
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+
+    return manifest if manifest.get("version") == MANIFEST_VERSION else None
+
+def save_manifest(manifest_path: str, manifest: Dict[str, Any]):
+    """Save the manifest of the current export."""
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+def get_export_state(conn: sqlite3.Connection, metadata_json: str, where: str = "", params: tuple = ()) -> Dict[str, Any]:
+    """Read the watermarks and per-channel message counts that make up the manifest of an export."""
+    cursor = conn.cursor()
+
+    cursor.execute(f"SELECT MAX(message_id), MAX(timestamp) FROM messages{messages_where(where)}", params)
+    last_message_id, last_timestamp = cursor.fetchone()
+
+    cursor.execute(f"SELECT MAX(s.edit_timestamp) FROM message_edit_timestamps s{side_table_where(where)}", params)
+    last_edit_timestamp = cursor.fetchone()[0]
+
+    cursor.execute(f"SELECT channel_id, COUNT(*) FROM messages{messages_where(where)} GROUP BY channel_id", params)
+    channels = {str(channel_id): count for channel_id, count in cursor.fetchall()}
+
+    return {
+        "version": MANIFEST_VERSION,
+        "last_message_id": str(last_message_id or 0),
+        "last_timestamp": last_timestamp or 0,
+        "last_edit_timestamp": last_edit_timestamp or 0,
+        "channels": channels,
+        "metadata_hash": hashlib.sha256(metadata_json.encode("utf-8")).hexdigest(),
+        "filter": {
+            "where": where,
+            "params": list(params)
+        }
+    }
+
+def get_incremental_filter(conn: sqlite3.Connection, manifest: Dict[str, Any],
+                           state: Dict[str, Any]) -> Tuple[str, tuple, Set[str]]:
+    """Build the condition selecting messages that changed since the manifest was written.
+
+    Returns the condition, its params and the channels that have to be exported again
+    completely, because their message count changed by more than the new messages
+    explain (older history was saved, or messages were removed).
+    """
+    last_message_id = int(manifest["last_message_id"])
+
+    export_filter = state["filter"]
+    export_where, export_params = export_filter["where"], tuple(export_filter["params"])
+
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT channel_id, COUNT(*) FROM messages WHERE {and_where(export_where, 'message_id > ?')} GROUP BY channel_id",
+                   export_params + (last_message_id,))
+    new_counts = {str(channel_id): count for channel_id, count in cursor.fetchall()}
+
+    old_counts = manifest["channels"]
+    stale_channels = {
+        channel for channel in old_counts.keys() | state["channels"].keys()
+        if state["channels"].get(channel, 0) - old_counts.get(channel, 0) != new_counts.get(channel, 0)
+    }
+
+    where = ("message_id > ? OR timestamp > ?"
+             " OR message_id IN (SELECT message_id FROM message_edit_timestamps WHERE edit_timestamp > ?)")
+    params = (last_message_id, manifest["last_timestamp"], manifest["last_edit_timestamp"])
+
+    if stale_channels:
+        where += f" OR channel_id IN ({', '.join('?' * len(stale_channels))})"
+        params += tuple(int(channel) for channel in stale_channels)
+
+    return and_where(export_where, where), export_params + params, stale_channels
+
+def parse_message_lines(lines: Iterable[str]) -> Iterator[Tuple[int, str, str]]:
+    """Yield (message id, channel id, line) for encoded message lines."""
+    for line in lines:
+        match = MESSAGE_LINE_PREFIX.match(line)
+        yield int(match[1]), match[2], line
+
+def merge_message_store(store_path: str, updates: Iterable[str], stale_channels: Set[str],
+                        keep_stored: bool = True) -> Generator[str, None, None]:
+    """Merge updated message lines into the message store, yielding the merged lines.
+
+    Both the store and the updates are ordered by message id. Updated lines replace
+    stored lines with the same id and stored lines of stale channels are dropped, or
+    all of them without keep_stored. The store file is replaced once every line was
+    yielded.
+    """
+    temp_path = store_path + ".tmp"
+
+    with contextlib.ExitStack() as stack:
+        output = stack.enter_context(open(temp_path, "w", encoding="utf-8"))
+        stored_lines = []
+        if keep_stored and os.path.exists(store_path):
+            stored_lines = (line.rstrip("\n") for line in stack.enter_context(open(store_path, "r", encoding="utf-8")))
+
+        # Updates sort before stored lines with the same id, so they win when merging
+        merged = heapq.merge(
+            ((message_id, 0, line) for message_id, _, line in parse_message_lines(updates)),
+            ((message_id, 1, line) for message_id, channel, line in parse_message_lines(stored_lines)
+             if channel not in stale_channels)
+        )
+
+        for _, group in itertools.groupby(merged, key=lambda item: item[0]):
+            line = next(group)[2]
+            output.write(line)
+            output.write("\n")
+            yield line
+
+    os.replace(temp_path, store_path)
+
+def generate_incremental_messages_ndjson(db_path: str, store_path: str, manifest_path: str, metadata_json: str,
+                                         num_workers: int = 0, window: int = 10000,
+                                         where: str = "", params: tuple = ()) -> Generator[str, None, None]:
+    """Generate x-ndjson formatted messages from the message store, updated with messages that changed since the last export."""
+    conn = connect(db_path)
+    state = get_export_state(conn, metadata_json, where, params)
+    manifest = load_manifest(manifest_path) if os.path.exists(store_path) else None
+
+    if manifest is not None and manifest.get("filter") != state["filter"]:
+        log("Export filters changed since the previous export")
+        manifest = None
+
+    if manifest is None:
+        log("No previous export found, exporting all messages")
+        stale_channels = set()
+    else:
+        where, params, stale_channels = get_incremental_filter(conn, manifest, state)
+        if manifest["metadata_hash"] != state["metadata_hash"]:
+            log("Metadata changed since the previous export")
+        log(f"Updating previous export: {count_messages(conn, where, params)} new or edited messages, "
+              f"{len(stale_channels)} channels exported again")
+
+    conn.close()
+
+    updates = generate_messages_ndjson(db_path, order="id", window=window, num_workers=num_workers, where=where, params=params)
+    yield from merge_message_store(store_path, updates, stale_channels, keep_stored=manifest is not None)
+
+    save_manifest(manifest_path, state)
+
+def join_lines(lines: Iterable[str]) -> Iterator[str]:
+    """Yield lines separated by newlines, same as "\\n".join() without building the string."""
+    for idx, line in enumerate(lines):
+        if idx > 0:
+            yield "\n"
+        yield line
+
+def tee_lines(lines: Iterable[str], file: TextIO) -> Iterator[str]:
+    """Yield lines while also writing them to another file, separated by newlines."""
+    for idx, line in enumerate(lines):
+        if idx > 0:
+            file.write("\n")
+        file.write(line)
+        yield line
+
+def write_channel_shards(shard_dir: str, shard_url: str, lines: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    """Write message lines grouped by channel into one script file per channel, returning the shard of each channel.
+
+    Each script passes the messages of its channel to window.DHT_LOAD_SHARD, so the
+    viewer can load it on demand with a script tag, which also works for local files.
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    shards = {}
+
+    for channel, group in itertools.groupby(parse_message_lines(lines), key=lambda item: item[1]):
+        with open(os.path.join(shard_dir, f"{channel}.js"), "w", encoding="utf-8") as file:
+            file.write(f'window.DHT_LOAD_SHARD("{channel}", [\n')
+            count = 0
+            for _, _, line in group:
+                if count > 0:
+                    file.write(",\n")
+                file.write(line)
+                count += 1
+            file.write("\n]);\n")
+
+        shards[channel] = {
+            "file": f"{shard_url}/{channel}.js",
+            "count": count
+        }
+
+    return shards
+
+# Id prefix of the script tags holding the messages of one channel each
+CHANNEL_BLOCK_ID = "viewer-channel-"
+
+def generate_channel_blocks(lines: Iterable[str], encode: Callable[[Iterable[str]], Iterable[str]],
+                            compression: Optional[str] = None) -> Iterator[str]:
+    """Wrap message lines grouped by channel into one script tag per channel, which the viewer
+    only decodes when the channel is first opened.
+
+    The lines of each channel are turned into the embedded payload by encode, and compressed
+    on their own if requested.
+    """
+    for channel, group in itertools.groupby(parse_message_lines(lines), key=lambda item: item[1]):
+        block = join_lines(encode(line for _, _, line in group))
+        if compression:
+            block = compress_chunks(block, compression)
+        yield f'<script id="{CHANNEL_BLOCK_ID}{channel}" type="application/x-ndjson" data-compression="{compression or ""}">\n'
+        yield from block
+        yield "\n</script>\n"
+
+def generate_channel_ndjson(lines: Iterable[str], window: int = 10000) -> Iterator[str]:
+    """Convert message lines grouped by channel and ordered by id into channel blocks of at most window messages.
+
+    Each block has the channel, the message ids in order and the messages without
+    their id and channel, which are cut off the encoded lines instead of decoding them.
+    """
+    matches = (MESSAGE_LINE_PREFIX.match(line) for line in lines)
+    for channel, group in itertools.groupby(matches, key=lambda match: match[2]):
+        while True:
+            matches = list(itertools.islice(group, window))
+            if not matches:
+                break
+            ids = ",".join(f'"{match[1]}"' for match in matches)
+            messages = ",".join("{" + match.string[match.end() + 1:] for match in matches)
+            yield f'{{"c":"{channel}","ids":[{ids}],"messages":[{messages}]}}'
+
+# Optional message fields of the columnar payload, stored sparsely
+COLUMNAR_FIELDS = ("m", "a", "e", "te", "re", "r")
+
+# Largest integer JavaScript numbers hold exactly, larger id deltas are written as strings
+MAX_SAFE_INTEGER = 2 ** 53 - 1
+
+def encode_columnar_block(channel: str, messages: List[Dict[str, Any]]) -> str:
+    """Encode messages of a channel, ordered by id, as a columnar block.
+
+    Ids and timestamps are delta encoded from the previous message, users are indexes
+    into a user table of the block, and each optional field only lists the messages
+    that have it, as delta encoded indexes with their values. Edit timestamps are
+    relative to the message timestamp.
+    """
+    users = {}
+    ids, user_indexes, timestamps = [], [], []
+    columns = {field: ([], []) for field in COLUMNAR_FIELDS}
+    last_indexes = dict.fromkeys(COLUMNAR_FIELDS, 0)
+    last_id = last_timestamp = 0
+
+    for index, message in enumerate(messages):
+        message_id = int(message["id"])
+        delta = message_id - last_id
+        ids.append(delta if delta <= MAX_SAFE_INTEGER else str(delta))
+        last_id = message_id
+
+        user_indexes.append(users.setdefault(message["u"], len(users)))
+        timestamps.append(message["t"] - last_timestamp)
+        last_timestamp = message["t"]
+
+        for field in COLUMNAR_FIELDS:
+            if field in message:
+                indexes, values = columns[field]
+                indexes.append(index - last_indexes[field])
+                values.append(message[field] - message["t"] if field == "te" else message[field])
+                last_indexes[field] = index
+
+    block = {
+        "c": channel,
+        "users": list(users),
+        "id": ids,
+        "u": user_indexes,
+        "t": timestamps
+    }
+    for field, (indexes, values) in columns.items():
+        if indexes:
+            block[field] = {"i": indexes, "v": values}
+    return encode_message(block)
+
+def generate_columnar_ndjson(lines: Iterable[str], window: int = 10000) -> Iterator[str]:
+    """Convert message lines grouped by channel and ordered by id into columnar blocks of at most window messages."""
+    for channel, group in itertools.groupby(map(decode_message, lines), key=lambda message: message["c"]):
+        while True:
+            messages = list(itertools.islice(group, window))
+            if not messages:
+                break
+            yield encode_columnar_block(channel, messages)
+
+# Tokens of the search index are runs of ASCII letters and digits and any other characters,
+# so the viewer splits text the same way with an equivalent UTF-16 pattern
+SEARCH_TOKEN = re.compile(r"[0-9A-Za-z\x80-\U0010ffff]+")
+
+def encode_varint(value: int, out: bytearray):
+    """Append an unsigned integer to out, 7 bits per byte starting with the lowest, the high bit set on all but the last byte."""
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+def build_search_index(db_path: str, where: str = "", params: tuple = (), window: int = 10000) -> Dict[str, Any]:
+    """Build an inverted index from the tokens of message text to the messages containing them.
+
+    Messages are numbered by channel, then by id, which is the order the viewer keeps
+    each channel in. The posting list of each token is written as the byte length of the
+    list followed by the differences between its message numbers, all as varints.
+    """
+    conn = connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT channel_id, text FROM messages{messages_where(where)} ORDER BY channel_id, message_id", params)
+
+    channels = []
+    postings = collections.defaultdict(lambda: array.array("I"))
+    ordinal = 0
+    for channel, rows in itertools.groupby(iter_rows(cursor, window, "search_index_query"), key=lambda row: row[0]):
+        start = ordinal
+        for _, text in rows:
+            if text:
+                for token in set(SEARCH_TOKEN.findall(text)):
+                    postings[token].append(ordinal)
+            ordinal += 1
+        channels.append([str(channel), ordinal - start])
+    conn.close()
+
+    # Sorted by UTF-16 code units like JavaScript strings, so the viewer can binary search them
+    tokens = sorted(postings, key=lambda token: token.encode("utf-16-be"))
+    blob = bytearray()
+    for token in tokens:
+        deltas = bytearray()
+        previous = 0
+        for ordinal in postings[token]:
+            encode_varint(ordinal - previous, deltas)
+            previous = ordinal
+        encode_varint(len(deltas), blob)
+        blob += deltas
+
+    return {
+        "channels": channels,
+        "tokens": tokens,
+        "postings": base64.b64encode(blob).decode("ascii")
+    }
+
+# Full-text search table of the database written with --fts. Only the text columns are
+# indexed, the rest identify the message.
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE messages USING fts5(
+    text, attachments, embeds,
+    message_id UNINDEXED, channel_id UNINDEXED, timestamp UNINDEXED,
+    tokenize = 'unicode61 remove_diacritics 2'
+)
+"""
+
+def get_fts_row(message: Dict[str, Any], strings: List[str]) -> tuple:
+    """Build the full-text search row of a decoded message, with its text, attachment names and embed titles and descriptions."""
+    attachments = "\n".join(attachment["name"] for attachment in message.get("a", ()))
+    embeds = []
+    for embed in message.get("e", ()):
+        embed = decode_message(strings[embed] if isinstance(embed, int) else embed)
+        embeds.extend(embed[key] for key in ("title", "description") if embed.get(key))
+    return message.get("m", ""), attachments, "\n".join(embeds), message["id"], message["c"], message["t"]
+
+def index_messages_fts(lines: Iterable[str], fts_path: str, strings: List[str] = (), window: int = 10000) -> Iterator[str]:
+    """Yield message lines while also adding them to a new full-text search database.
+
+    Rows are inserted window at a time in one transaction, and the database only
+    replaces the one at fts_path once every line was indexed.
+    """
+    temp_path = fts_path + ".tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    conn = sqlite3.connect(temp_path)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute(FTS_SCHEMA)
+
+    insert = profile_function("fts_insert", lambda rows: conn.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?)", rows),
+                              rows=lambda cursor: cursor.rowcount)
+    rows = []
+    for line in lines:
+        rows.append(get_fts_row(decode_message(line), strings))
+        if len(rows) >= window:
+            insert(rows)
+            rows = []
+        yield line
+    if rows:
+        insert(rows)
+
+    # Merge the index segments of every batch, which makes queries faster
+    conn.execute("INSERT INTO messages(messages) VALUES ('optimize')")
+    conn.commit()
+    conn.close()
+    os.replace(temp_path, fts_path)
+
+def search_fts(fts_path: str, query: str, channels: Optional[List[int]] = None, limit: int = 20) -> List[tuple]:
+    """Run an FTS5 query on a full-text search database, returning the message id, channel id, timestamp
+    and a snippet of the best matching messages."""
+    conn = sqlite3.connect(pathlib.Path(fts_path).absolute().as_uri() + "?mode=ro", uri=True)
+    sql = "SELECT message_id, channel_id, timestamp, snippet(messages, -1, '[', ']', '…', 16) FROM messages WHERE messages MATCH ?"
+    params = [query]
+    if channels:
+        sql += f" AND channel_id IN ({', '.join('?' * len(channels))})"
+        params.extend(str(channel) for channel in channels)
+    cursor = conn.execute(sql + " ORDER BY rank LIMIT ?", (*params, limit))
+    results = cursor.fetchall()
+    conn.close()
+    return results
+
+def search_main(argv: List[str]):
+    """Search the full-text search database of an export from the command line."""
+    parser = argparse.ArgumentParser(prog='dhtexporter.py search', description='Search the full-text search database written by --fts')
+    parser.add_argument('fts_file', help='Path to the <name>.fts.sqlite file next to the HTML file')
+    parser.add_argument('query', help='FTS5 query, for example: word, prefix*, "exact phrase", text:word OR embeds:word')
+    parser.add_argument('--channel', type=int, action='append', help='Only return messages from this channel (repeatable)')
+    parser.add_argument('--limit', type=int, default=20, help='Maximum number of results')
+    search_args = parser.parse_args(argv)
+
+    if not os.path.exists(search_args.fts_file):
+        parser.error(f"full-text search database '{search_args.fts_file}' does not exist")
+
+    start = time.perf_counter()
+    try:
+        results = search_fts(search_args.fts_file, search_args.query, search_args.channel, search_args.limit)
+    except sqlite3.OperationalError as e:
+        parser.error(f"invalid query: {e}")
+    elapsed = time.perf_counter() - start
+
+    for message_id, channel_id, timestamp, snippet in results:
+        sent = datetime.datetime.fromtimestamp(timestamp / 1000).isoformat(sep=" ", timespec="seconds")
+        print(f"{message_id}\t{channel_id}\t{sent}\t{' '.join(snippet.split())}")
+    print(f"{len(results)} results in {elapsed * 1000:.1f} ms", file=sys.stderr)
+
+# Compression formats of embedded data, named as in DecompressionStream, with their zlib window bits
+COMPRESSION_WBITS = {
+    "gzip": 16 + zlib.MAX_WBITS,
+    "deflate": zlib.MAX_WBITS
+}
+
+def compress_chunks(chunks: Iterable[str], compression: str) -> Iterator[str]:
+    """Compress text chunks as they come, yielding the compressed data as base64 text."""
+    compressor = zlib.compressobj(wbits=COMPRESSION_WBITS[compression])
+    pending = b""
+    for chunk in chunks:
+        pending += compressor.compress(chunk.encode("utf-8"))
+        # Only encode whole 3 byte groups, so the base64 text has no padding until the end
+        if len(pending) >= 3:
+            cut = len(pending) - len(pending) % 3
+            yield base64.b64encode(pending[:cut]).decode("ascii")
+            pending = pending[cut:]
+    yield base64.b64encode(pending + compressor.flush()).decode("ascii")
+
+def split_template(template: str, markers: Iterable[str]) -> List[str]:
+    """Split a template at its markers, returning text and markers interleaved."""
+    return re.split("(" + "|".join(re.escape(marker) for marker in markers) + ")", template)
+
+def template_sections(metadata: Iterable[str] = (), messages: Iterable[str] = (), channels: Iterable[str] = (),
+                      search_index: Iterable[str] = (), payload: str = "ndjson", compression: Optional[str] = None) -> Dict[str, Iterable[str]]:
+    """Return the chunks of every marker of the HTML template, leaving out the data that is not given.
+
+    The metadata, messages and search index are compressed as they are written if requested,
+    channel blocks come compressed from generate_channel_blocks().
+    """
+    if compression:
+        metadata = compress_chunks(metadata, compression)
+        messages = compress_chunks(messages, compression)
+        # An empty search index block tells the viewer there is no index
+        search_index = compress_chunks(search_index, compression) if search_index else []
+
+    return {
+        "//__COMPRESSION__": [compression or ""],
+        "//__PAYLOAD__": [payload],
+        "//__METADATA__": metadata,
+        "//__MESSAGES__": messages,
+        "//__CHANNELS__": channels,
+        "//__SEARCH_INDEX__": search_index,
+        "//__STYLE__": [style],
+        "//__SCRIPT__": [script]
+    }
+
+def render_html(sections: Dict[str, Iterable[str]]) -> Iterator[str]:
+    """Yield the HTML template in chunks, with the chunks of each section in place of its marker."""
+    for part in split_template(html_template, sections.keys()):
+        if part in sections:
+            yield from sections[part]
+        else:
+            yield part
+
+def write_html(html_path: str, sections: Dict[str, Iterable[str]]):
+    """Write the HTML template to a file, streaming the chunks of each section in place of its marker."""
+    with open(html_path, "wb") as file:
+        # Chunks are counted as bytes written rather than rows
+        write = profile_function("file_write", file.write, rows=lambda _: 0, size=lambda written: written)
+        for chunk in render_html(sections):
+            write(chunk.encode("utf-8"))
 
 def main():
     global args
+    # Other commands are named in place of the database file, exporting stays the default
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+        return
     args = parse_args()
 
+    # Start profiling before anything else, so the report covers the whole export
+    set_profiling(args.profile)
+    capture = args.profile_capture or []
+    if "tracemalloc" in capture:
+        tracemalloc.start()
+    profiler = cProfile.Profile() if "cprofile" in capture else None
+    if profiler is not None:
+        profiler.enable()
+    profile_start = (time.perf_counter(), time.process_time())
+
+    # Select output mode, JSON encoder and database connection profile
+    set_progress_quiet(args.quiet)
+    log(f"JSON backend: {set_json_backend(args.json_backend)}")
+    set_connection_profile(args.connection)
+    set_reply_resolution(args.resolve_replies)
+
     # Print initial counts
-    print_counts(args.sqlite_file)
+    with profile_stage("print_counts"):
+        print_counts(args.sqlite_file)
 
     # Ensure output directory exists
     os.makedirs(args.outdir, exist_ok=True)
@@ -265,40 +1592,282 @@ def main():
     # Base name for output files
     base_name = os.path.splitext(os.path.basename(args.sqlite_file))[0]
 
-    # Fetch and format metadata
-    metadata_json = json.dumps(fetch_metadata(args.sqlite_file), indent=2)
+    # Build the condition selecting exported messages
+    where, params = build_message_filter(args)
+
+    # Fetch metadata
+    with profile_stage("fetch_metadata") as stage:
+        metadata = fetch_metadata(args.sqlite_file, where, params, args.resolve_replies)
+        stage["rows"] = sum(len(metadata[key]) for key in ("users", "servers", "channels"))
 
-    # Generate messages in x-ndjson format (multi-threaded)
-    messages_ndjson = "\n".join(generate_messages_ndjson(args.sqlite_file, args.threads))
+    # Find strings used by several messages, so they are only stored once
+    if args.intern_strings:
+        with profile_stage("intern_strings") as stage:
+            strings, references, saved = find_repeated_strings(args.sqlite_file, where, params)
+            stage["rows"] = len(strings)
+        metadata["strings"] = strings
+        set_interned_strings(strings)
 
-    # Save JSON files if requested
+    metadata_path = os.path.join(args.outdir, "get-viewer-metadata.json")
+    messages_path = os.path.join(args.outdir, "get-viewer-messages.ndjson")
+    html_path = os.path.join(args.outdir, f"{base_name}.html")
+
+    with contextlib.ExitStack() as stack:
+        # Generate messages in x-ndjson format
+        if args.incremental:
+            store_path = os.path.join(args.outdir, f"{base_name}.messages.ndjson")
+            manifest_path = os.path.join(args.outdir, f"{base_name}.manifest.json")
+            messages = generate_incremental_messages_ndjson(args.sqlite_file, store_path, manifest_path,
+                                                            encode_metadata(metadata), args.workers, args.window, where, params)
+        else:
+            order = "channel" if args.shard or args.lazy_channels or args.payload != "ndjson" else "id" if args.stream else "timestamp"
+            messages = generate_messages_ndjson(args.sqlite_file, args.threads, args.assembly, order, args.window, args.workers,
+                                                where, params)
+
+        # Time spent generating messages that is not in a more specific stage, such as merging or waiting for workers
+        messages = profile_iter("generate_messages", messages)
+
+        # Save messages JSON file as they are generated if requested
+        if args.dump_json:
+            messages = tee_lines(messages, stack.enter_context(open(messages_path, "w", encoding="utf-8")))
+
+        # Add messages to the full-text search database as they pass through if requested
+        if args.fts:
+            fts_path = os.path.join(args.outdir, f"{base_name}.fts.sqlite")
+            messages = index_messages_fts(messages, fts_path, metadata.get("strings", []), args.window)
+
+        # Group messages into channel or columnar blocks if requested, after they were saved as regular messages
+        encode_payload = lambda lines: lines
+        if args.payload == "channels":
+            encode_payload = lambda lines: profile_iter("channel_grouping", generate_channel_ndjson(lines, args.window))
+        elif args.payload == "columnar":
+            encode_payload = lambda lines: profile_iter("columnar_encoding", generate_columnar_ndjson(lines, args.window))
+
+        # Embed each channel in its own block
+        channel_blocks = []
+        if args.lazy_channels:
+            metadata["shards"] = {channel: {"block": CHANNEL_BLOCK_ID + channel, "count": data["count"]}
+                                  for channel, data in metadata["channels"].items() if data["count"]}
+            metadata["shardBudget"] = args.lazy_budget
+            channel_blocks = generate_channel_blocks(messages, encode_payload, args.compress)
+            messages = []
+        else:
+            messages = encode_payload(messages)
+
+        # Write one data file per channel, the HTML file only gets the metadata
+        if args.shard:
+            shard_url = f"{base_name}_channels"
+            with profile_stage("write_shards") as stage:
+                metadata["shards"] = write_channel_shards(os.path.join(args.outdir, shard_url), shard_url, messages)
+                stage["rows"] = sum(shard["count"] for shard in metadata["shards"].values())
+            log(f"Saved {len(metadata['shards'])} channel data files to {os.path.join(args.outdir, shard_url)}")
+            messages = []
+
+        # Format metadata, sharded exports can only do it once all channels were written
+        with profile_stage("encode_metadata") as stage:
+            metadata_json = encode_metadata(metadata)
+            stage["bytes"] = len(metadata_json.encode("utf-8"))
+
+        # Build the search index of message text if requested
+        search_index_section = []
+        if args.search_index:
+            log("Indexing message text...", end="", flush=True)
+            with profile_stage("search_index") as stage:
+                search_index = build_search_index(args.sqlite_file, where, params, args.window)
+                search_index_json = encode_message(search_index)
+                stage["rows"] = len(search_index["tokens"])
+                stage["bytes"] = len(search_index_json)
+            log(f"Done, {len(search_index['tokens']):,} tokens in {len(search_index_json) / 1024:,.0f} KiB")
+            search_index_section = [search_index_json]
+
+        # Generate HTML file, messages are written (and compressed if requested) as they come off the generator
+        with profile_stage("template_assembly") as stage:
+            write_html(html_path, template_sections([metadata_json], join_lines(messages), channel_blocks,
+                                                    search_index_section, args.payload, args.compress))
+            stage["bytes"] = os.path.getsize(html_path)
+
+    # Save metadata JSON file if requested
     if args.dump_json:
-        metadata_path = os.path.join(args.outdir, "get-viewer-metadata.json")
         with open(metadata_path, "w", encoding="utf-8") as f:
             f.write(metadata_json)
 
-        messages_path = os.path.join(args.outdir, "get-viewer-messages.ndjson")
-        with open(messages_path, "w", encoding="utf-8") as f:
-            f.write(messages_ndjson)
+    if args.dump_json:
+        log(f"Saved metadata to {metadata_path}")
+        log(f"Saved messages to {messages_path}")
 
-        print(f"Saved metadata to {metadata_path}")
-        print(f"Saved messages to {messages_path}")
+    if args.fts:
+        log(f"Saved full-text search database to {fts_path}")
 
-    # Generate HTML file
-    html_path = os.path.join(args.outdir, f"{base_name}.html")
+    if args.intern_strings:
+        log(f"Interned {len(strings)} strings replacing {references} copies, saving {saved / 1024:,.0f} KiB "
+            f"({saved / (saved + os.path.getsize(html_path)):.1%} of the HTML file) that the viewer no longer parses")
 
-    final_html = (
-        html_template
-        .replace("//__METADATA__", metadata_json)
-        .replace("//__MESSAGES__", messages_ndjson)
-        .replace("//__STYLE__", style)
-        .replace("//__SCRIPT__", script)
-    )
+    log(f"HTML generated successfully at {html_path}")
+
+    if args.profile:
+        if profiler is not None:
+            profiler.disable()
+        report_path = os.path.join(args.outdir, f"{base_name}.profile.json")
+        save_profile_report(report_path, profile_start, profiler)
+        log(f"Saved profile report to {report_path}")
+
+
+# Request parameters of the serve endpoints that select messages, parsed like the export options of the same name
+SERVE_FILTER_PARAMS = {
+    "server": int,
+    "channel": int,
+    "user": int,
+    "since": parse_time,
+    "until": parse_time
+}
+
+def parse_filter_query(query: Dict[str, List[str]]) -> argparse.Namespace:
+    """Parse the filter parameters of a request into the arguments build_message_filter() takes."""
+    values = {name: [parse(value) for value in query.get(name, [])] or None for name, parse in SERVE_FILTER_PARAMS.items()}
+    for name in ("since", "until"):
+        values[name] = values[name][-1] if values[name] else None
+    return argparse.Namespace(**values)
 
-    with open(html_path, "w", encoding="utf-8") as file:
-        file.write(final_html)
-    print(f"HTML generated successfully at {html_path}")
+def get_database_state(db_path: str) -> List[Tuple[int, int]]:
+    """Return the modification time and size of the database and its write-ahead log, which change with its data."""
+    paths = [path for path in (db_path, db_path + "-wal") if os.path.exists(path)]
+    return [(stat.st_mtime_ns, stat.st_size) for stat in map(os.stat, paths)]
 
+def gzip_chunks(chunks: Iterable[str]) -> Iterator[bytes]:
+    """Compress text chunks with gzip as they come."""
+    compressor = zlib.compressobj(wbits=COMPRESSION_WBITS["gzip"])
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+class ViewerRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serve the viewer page and stream its metadata and messages from the database, for the serve command."""
+    server_version = "dhtexporter"
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        routes = {
+            "/": self.get_viewer,
+            "/get-viewer-metadata": self.get_viewer_metadata,
+            "/get-viewer-messages": self.get_viewer_messages
+        }
+        if url.path not in routes:
+            self.send_error(404)
+            return
+        if not secrets.compare_digest(query.get("token", [""])[0], self.server.token):
+            self.send_error(403, "Invalid token")
+            return
+        try:
+            where, params = build_message_filter(parse_filter_query(query))
+        except (ValueError, argparse.ArgumentTypeError) as e:
+            self.send_error(400, str(e))
+            return
+
+        # Responses only change with the database, so the viewer can revalidate them cheaply when reloaded
+        filters = sorted((name, value) for name, value in urllib.parse.parse_qsl(url.query) if name in SERVE_FILTER_PARAMS)
+        state = (self.server.version, url.path, filters, get_database_state(self.server.db_path))
+        etag = f'W/"{hashlib.sha1(repr(state).encode("utf-8")).hexdigest()[:20]}"'
+        if etag in (tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        content_type, chunks = routes[url.path](where, params)
+        use_gzip = "gzip" in self.headers.get("Accept-Encoding", "")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("ETag", etag)
+        self.send_header("Vary", "Accept-Encoding")
+        if use_gzip:
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+
+        # Without a content length, the response ends when the connection is closed after the last chunk
+        try:
+            for data in gzip_chunks(chunks) if use_gzip else (chunk.encode("utf-8") for chunk in chunks):
+                self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            chunks.close()
+
+    def get_viewer(self, where: str, params: tuple) -> Tuple[str, Iterator[str]]:
+        # The data is fetched by the viewer once it is loaded
+        return "text/html; charset=utf-8", render_html(template_sections(payload="channels"))
+
+    def get_viewer_metadata(self, where: str, params: tuple) -> Tuple[str, Iterator[str]]:
+        def generate():
+            metadata = fetch_metadata(self.server.db_path, where, params, resolve_replies)
+            close_db_connections()
+            yield encode_metadata(metadata)
+        return "application/json; charset=utf-8", generate()
+
+    def get_viewer_messages(self, where: str, params: tuple) -> Tuple[str, Iterator[str]]:
+        lines = generate_messages_ndjson(self.server.db_path, order="channel", window=self.server.window, where=where, params=params)
+        return "application/x-ndjson; charset=utf-8", join_lines(generate_channel_ndjson(lines, self.server.window))
+
+    def log_message(self, format: str, *values):
+        if not self.server.quiet:
+            super().log_message(format, *values)
+
+def serve_main(argv: List[str]):
+    """Serve the viewer over a database from a local HTTP server."""
+    parser = argparse.ArgumentParser(prog='dhtexporter.py serve',
+                                     description='Browse a DHT database in the viewer from a local HTTP server, '
+                                                 'which streams messages from the database instead of writing an HTML file')
+    parser.add_argument('sqlite_file', help='Path to DHT SQLite database file')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on (0 picks a free one)')
+    parser.add_argument('--window', type=int, default=1000, help='Messages per channel block streamed to the viewer')
+    parser.add_argument('--json-backend', choices=['auto', *JSON_BACKENDS], default='auto',
+                        help='JSON encoder to use, auto picks the fastest one installed')
+    parser.add_argument('--connection', choices=['tuned', 'default'], default='tuned',
+                        help='Open the database read-only with memory-mapped I/O and a larger cache (tuned, sorting in temporary files) or with SQLite defaults')
+    parser.add_argument('--resolve-replies', action='store_true',
+                        help='Embed the channel, author and a preview of replied to messages, also for messages outside the browsed part')
+    parser.add_argument('--quiet', action='store_true', help='Do not log requests')
+    serve_args = parser.parse_args(argv)
+
+    if not os.path.exists(serve_args.sqlite_file):
+        parser.error(f"database '{serve_args.sqlite_file}' does not exist")
+    if serve_args.window < 1:
+        parser.error("--window must be at least 1")
+    if serve_args.json_backend != 'auto' and JSON_BACKENDS[serve_args.json_backend] is None:
+        parser.error(f"JSON backend '{serve_args.json_backend}' is not installed")
+
+    # Requests run in threads of their own, so the progress of generating messages is never printed
+    set_progress_quiet(True)
+    set_json_backend(serve_args.json_backend)
+    # Every request sorts the messages it streams, which could be the whole database, so sorts do not stay in memory
+    set_connection_profile("serve" if serve_args.connection == "tuned" else serve_args.connection)
+    set_reply_resolution(serve_args.resolve_replies)
+
+    server = http.server.ThreadingHTTPServer((serve_args.host, serve_args.port), ViewerRequestHandler)
+    server.db_path = serve_args.sqlite_file
+    server.window = serve_args.window
+    server.quiet = serve_args.quiet
+    server.token = secrets.token_urlsafe(16)
+    server.version = hashlib.sha1((html_template + style + script + repr(vars(serve_args))).encode("utf-8")).hexdigest()
+
+    print(f"Serving {serve_args.sqlite_file} at http://{serve_args.host}:{server.server_port}/?token={server.token}&session=0")
+    print("Add &channel=<id>, &server=<id>, &user=<id>, &since=<date> or &until=<date> to the address to only browse part of it")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+# Commands other than exporting, run with the arguments after their name
+COMMANDS = {
+    "search": search_main,
+    "serve": serve_main
+}
 
 # Only template definitions below this line
 html_template = r"""
@@ -313,15 +1882,23 @@ html_template = r"""
     <!--link rel="icon" href="favicon.ico"-->
 
     <!-- Embed JSON metadata -->
-    <script id="viewer-metadata" type="application/json">
+    <script id="viewer-metadata" type="application/json" data-compression="//__COMPRESSION__">
     //__METADATA__
     </script>
 
     <!-- Embed JSON messages -->
-    <script id="viewer-messages" type="application/x-ndjson">
+    <script id="viewer-messages" type="application/x-ndjson" data-compression="//__COMPRESSION__" data-payload="//__PAYLOAD__">
     //__MESSAGES__
     </script>
 
+    <!-- Embed JSON messages of each channel -->
+    //__CHANNELS__
+
+    <!-- Embed JSON search index -->
+    <script id="viewer-search-index" type="application/json" data-compression="//__COMPRESSION__">
+    //__SEARCH_INDEX__
+    </script>
+
     <script type="text/javascript">
 		const query = new URLSearchParams(location.search);
 		window.DHT_SERVER_TOKEN = query.get("token");
@@ -388,6 +1965,8 @@ html_template = r"""
 
       <div class="separator"></div>
 
+      <div id="load-progress"></div>
+
       <button id="btn-about">About</button>
     </div>
 
@@ -458,6 +2037,15 @@ body {
 #menu .separator {
   flex: 1 1 0;
 }
+#menu #load-progress {
+  align-self: center;
+  color: #aaa;
+  font-size: 14px;
+  white-space: nowrap;
+}
+#menu #load-progress:empty {
+  display: none;
+}
 #menu :disabled {
   background-color: #555;
   cursor: default;
@@ -569,6 +2157,10 @@ body {
   padding: 4px 0 12px;
   border-bottom: 1px solid rgba(255, 255, 255, 0.04);
 }
+#messages > div.virtual-spacer {
+  padding: 0;
+  border: 0;
+}
 #messages h2 {
   margin: 0;
   padding: 0;
@@ -1015,10 +2607,135 @@ var processor_default = {
   SORTER: sorter
 };
 
+// scripts/search.mjs
+var search_default = function() {
+  // Same tokens as SEARCH_TOKEN of the exporter, whose non-ASCII characters are UTF-16 code units here
+  const tokenPattern = /[0-9A-Za-z\u0080-\uffff]+/g;
+  let channelStarts;
+  let channelCounts;
+  let messageCount;
+  let tokens;
+  let postings;
+  let postingStarts;
+  const readVarint = function(position) {
+    let value = 0;
+    let shift = 1;
+    let byte;
+    do {
+      byte = postings[position.offset++];
+      value += (byte & 127) * shift;
+      shift *= 128;
+    } while (byte & 128);
+    return value;
+  };
+  const findToken = function(token) {
+    let low = 0;
+    let high = tokens.length;
+    while (low < high) {
+      const middle = low + high >>> 1;
+      if (tokens[middle] < token) {
+        low = middle + 1;
+      } else {
+        high = middle;
+      }
+    }
+    return low;
+  };
+  const findMatchingTokens = function(token, boundedLeft, boundedRight) {
+    // A token of the text that is followed or preceded by a separator must end or start a token of the message
+    const matches = [];
+    if (boundedLeft) {
+      for (let i = findToken(token); i < tokens.length && tokens[i].startsWith(token); i++) {
+        if (!boundedRight || tokens[i] === token) {
+          matches.push(i);
+        }
+      }
+    } else {
+      for (let i = 0; i < tokens.length; i++) {
+        if (boundedRight ? tokens[i].endsWith(token) : tokens[i].includes(token)) {
+          matches.push(i);
+        }
+      }
+    }
+    return matches;
+  };
+  return {
+    load(index) {
+      channelStarts = /* @__PURE__ */ new Map();
+      channelCounts = /* @__PURE__ */ new Map();
+      messageCount = 0;
+      for (const [channel, count] of index.channels) {
+        channelStarts.set(channel, messageCount);
+        channelCounts.set(channel, count);
+        messageCount += count;
+      }
+      tokens = index.tokens;
+      const binary = atob(index.postings);
+      postings = new Uint8Array(binary.length);
+      for (let i = 0; i < binary.length; i++) {
+        postings[i] = binary.charCodeAt(i);
+      }
+      postingStarts = new Uint32Array(tokens.length + 1);
+      const position = { offset: 0 };
+      for (let i = 0; i < tokens.length; i++) {
+        const length = readVarint(position);
+        postingStarts[i] = position.offset;
+        position.offset += length;
+      }
+      postingStarts[tokens.length] = position.offset;
+    },
+    isLoaded() {
+      return !!tokens;
+    },
+    getMessageCount(channel) {
+      return channelCounts.get(channel) || 0;
+    },
+    /**
+     * Finds the messages that may contain the text, as a map of channels to the positions of those messages in the channel sorted by id, or null if the text has no tokens to look up.
+     */
+    findCandidates(text) {
+      const queryTokens = Array.from(text.matchAll(tokenPattern)).slice(0, 255);
+      if (queryTokens.length === 0) {
+        return null;
+      }
+      // Messages are counted up once per token they match, so only those that match all of them reach the end
+      const marks = new Uint8Array(messageCount);
+      for (let i = 0; i < queryTokens.length; i++) {
+        const match = queryTokens[i];
+        const boundedLeft = match.index > 0;
+        const boundedRight = match.index + match[0].length < text.length;
+        for (const token of findMatchingTokens(match[0], boundedLeft, boundedRight)) {
+          const position = { offset: postingStarts[token] };
+          let ordinal = 0;
+          while (position.offset < postingStarts[token + 1]) {
+            ordinal += readVarint(position);
+            if (marks[ordinal] === i) {
+              marks[ordinal] = i + 1;
+            }
+          }
+        }
+      }
+      const candidates = /* @__PURE__ */ new Map();
+      for (const [channel, start] of channelStarts) {
+        const positions = [];
+        for (let i = 0, count = channelCounts.get(channel); i < count; i++) {
+          if (marks[start + i] === queryTokens.length) {
+            positions.push(i);
+          }
+        }
+        candidates.set(channel, positions);
+      }
+      return candidates;
+    }
+  };
+}();
+
 // scripts/state.mjs
 var state_default = function() {
   let loadedFileMeta;
   let loadedFileData;
+  let loadedFileKeys;
+  let loadedMessageChannels;
   let loadedMessages;
   let filterFunction;
   let selectedChannel;
@@ -1112,7 +2829,7 @@ var state_default = function() {
       "id": key,
       "name": channels[key].name,
       "server": getServer(channels[key].server),
-      "msgcount": getFilteredMessageKeys(key).length,
+      "msgcount": getMessageCount(key),
       "topic": channels[key].topic || "",
       "nsfw": channels[key].nsfw || false
     })).sort((ac, bc) => {
@@ -1122,70 +2839,208 @@ var state_default = function() {
   const getMessages = function(channel) {
     return loadedFileData[channel] || {};
   };
-  const getMessageById = function(id) {
-    for (const messages of Object.values(loadedFileData)) {
-      if (id in messages) {
-        return messages[id];
+  // Message counts of channels with the active filter, counted a few channels at a time whenever the filter changes
+  let filteredCounts = /* @__PURE__ */ new Map();
+  let filteredCountsTimer = null;
+  const getMessageCount = function(channel) {
+    if (isShardPending(channel)) {
+      // Messages of channels that are not loaded cannot be filtered yet
+      return filterFunction ? "\u2026" : loadedFileMeta.shards[channel].count;
+    }
+    const count = loadedFileMeta.channels[channel].count;
+    if (!filterFunction || count === 0) {
+      return count !== void 0 ? count : Object.keys(getMessages(channel)).length;
+    }
+    return filteredCounts.has(channel) ? filteredCounts.get(channel) : "\u2026";
+  };
+  const countFilteredMessages = function(messages, keys) {
+    let count = 0;
+    for (const key of keys) {
+      if (filterFunction(messages[key])) {
+        count++;
+      }
+    }
+    return count;
+  };
+  const startFilteredCounts = function() {
+    clearTimeout(filteredCountsTimer);
+    filteredCounts = /* @__PURE__ */ new Map();
+    if (!filterFunction) {
+      return;
+    }
+    const pending = Object.keys(loadedFileData);
+    const countSlice = function() {
+      const deadline = performance.now() + 12;
+      while (pending.length && performance.now() < deadline) {
+        const channel = pending.pop();
+        if (channel in loadedFileData) {
+          filteredCounts.set(channel, getFilteredMessageKeys(channel).length);
+        }
+      }
+      filteredCountsTimer = pending.length ? setTimeout(countSlice, 0) : null;
+      triggerChannelsRefreshed(selectedChannel);
+    };
+    filteredCountsTimer = setTimeout(countSlice, 0);
+  };
+  const shardRequests = {};
+  const isShardPending = function(channel) {
+    return !!loadedFileMeta.shards && channel in loadedFileMeta.shards && !(channel in loadedFileData);
+  };
+  const loadShard = function(channel) {
+    if (!shardRequests[channel] && loadedFileMeta.shards[channel].block) {
+      // Channels of --lazy-channels exports are embedded blocks, decoded by the bootstrap and added once complete
+      const batches = [];
+      shardRequests[channel] = eventOnChannelBlockRequested(loadedFileMeta.shards[channel].block, (ids, messages) => batches.push([ids, messages])).then(() => {
+        loadedFileData[channel] = {};
+        for (const [ids, messages] of batches) {
+          root.appendChannelMessages(channel, ids, messages, true);
+        }
+      }, (e) => {
+        delete shardRequests[channel];
+        throw e;
+      });
+    }
+    if (!shardRequests[channel]) {
+      shardRequests[channel] = new Promise((resolve, reject) => {
+        const script = document.createElement("script");
+        script.src = loadedFileMeta.shards[channel].file;
+        script.onload = () => {
+          script.remove();
+          channel in loadedFileData ? resolve() : reject("Channel data file did not load any messages: " + script.src);
+        };
+        script.onerror = () => {
+          script.remove();
+          delete shardRequests[channel];
+          reject("Could not load channel data file: " + script.src);
+        };
+        document.head.appendChild(script);
+      });
+    }
+    return shardRequests[channel];
+  };
+  // Decoded channels of --lazy-channels exports, least recently opened first, with their message counts
+  const shardUsage = /* @__PURE__ */ new Map();
+  const useShard = function(channel) {
+    const budget = loadedFileMeta.shardBudget;
+    if (!budget || !loadedFileMeta.shards[channel]) {
+      return;
+    }
+    shardUsage.delete(channel);
+    shardUsage.set(channel, loadedFileMeta.shards[channel].count);
+    let total = 0;
+    for (const count of shardUsage.values()) {
+      total += count;
+    }
+    for (const [oldest, count] of shardUsage) {
+      if (total <= budget || oldest === channel) {
+        break;
       }
+      dropShard(oldest);
+      total -= count;
+    }
+  };
+  const dropShard = function(channel) {
+    // The block stays in the page, so the channel is decoded again the next time it is opened. The channels
+    // of its messages are kept, so replies and jumps to them know which channel to load.
+    delete loadedFileData[channel];
+    delete loadedFileKeys[channel];
+    delete shardRequests[channel];
+    shardUsage.delete(channel);
+    filteredCounts.delete(channel);
+    sortedKeys.delete(channel);
+  };
+  const indexChannelMessages = function(channel) {
+    for (const id of isChannelSorted(channel) ? loadedFileKeys[channel] : Object.keys(loadedFileData[channel])) {
+      loadedMessageChannels.set(id, channel);
     }
-    return null;
+  };
+  const getMessageById = function(id) {
+    const channel = loadedMessageChannels.get(id);
+    return channel === void 0 || !(channel in loadedFileData) ? null : loadedFileData[channel][id];
   };
   const getMessageChannel = function(id) {
-    for (const [channel, messages] of Object.entries(loadedFileData)) {
-      if (id in messages) {
-        return channel;
+    const channel = loadedMessageChannels.get(id);
+    return channel === void 0 ? null : channel;
+  };
+  const findMessageIndex = function(keys, id) {
+    // Message lists are always sorted oldest to newest, so they can be binary searched
+    let low = 0;
+    let high = keys.length - 1;
+    while (low <= high) {
+      const middle = low + high >>> 1;
+      const order = processor_default.SORTER.oldestToNewest(keys[middle], id);
+      if (order < 0) {
+        low = middle + 1;
+      } else if (order > 0) {
+        high = middle - 1;
+      } else {
+        return middle;
       }
     }
-    return null;
+    return -1;
   };
   const getMessageList = function() {
+    // Message objects are only built for the messages that are shown, see gui_default.updateMessageList
     if (!loadedMessages) {
-      return [];
+      return { length: 0, get: null };
     }
+    const keys = loadedMessages;
     const messages = getMessages(selectedChannel);
-    const startIndex = messagesPerPage * (root.getCurrentPage() - 1);
-    return loadedMessages.slice(startIndex, !messagesPerPage ? void 0 : startIndex + messagesPerPage).map((key) => {
-      const message = messages[key];
-      const user = getUser(message.u);
-      const avatar = user.avatar ? { id: message.u, path: user.avatar } : null;
-      const obj = {
-        user,
-        avatar,
-        "timestamp": message.t,
-        "jump": key
-      };
-      if ("m" in message) {
-        obj["contents"] = message.m;
-      }
-      if ("e" in message) {
-        obj["embeds"] = message.e.map((embed) => JSON.parse(embed));
-      }
-      if ("a" in message) {
-        obj["attachments"] = message.a;
-      }
-      if ("te" in message) {
-        obj["edit"] = message.te;
-      }
-      if ("r" in message) {
-        const replyMessage = getMessageById(message.r);
-        const replyUser = replyMessage ? getUser(replyMessage.u) : null;
-        const replyAvatar = replyUser && replyUser.avatar ? { id: replyMessage.u, path: replyUser.avatar } : null;
-        obj["reply"] = replyMessage ? {
-          "id": message.r,
-          "user": replyUser,
-          "avatar": replyAvatar,
-          "contents": replyMessage.m
-        } : null;
-      }
-      if ("re" in message) {
-        obj["reactions"] = message.re;
-      }
-      return obj;
-    });
+    const startIndex = messagesPerPage * (root.getCurrentPage() - 1) || 0;
+    const endIndex = !messagesPerPage ? keys.length : Math.min(keys.length, startIndex + messagesPerPage);
+    return {
+      length: Math.max(0, endIndex - startIndex),
+      get: (index) => getMessage(messages, keys[startIndex + index])
+    };
+  };
+  const getMessage = function(messages, key) {
+    const message = messages[key];
+    const user = getUser(message.u);
+    const avatar = user.avatar ? { id: message.u, path: user.avatar } : null;
+    const obj = {
+      user,
+      avatar,
+      "timestamp": message.t,
+      "jump": key
+    };
+    if ("m" in message) {
+      obj["contents"] = message.m;
+    }
+    if ("e" in message) {
+      obj["embeds"] = message.e.map((embed) => JSON.parse(root.resolveString(embed)));
+    }
+    if ("a" in message) {
+      obj["attachments"] = message.a.map((attachment) => typeof attachment.url === "number" ? { ...attachment, url: root.resolveString(attachment.url) } : attachment);
+    }
+    if ("te" in message) {
+      obj["edit"] = message.te;
+    }
+    if ("r" in message) {
+      // Resolved replies already hold the author and text of the message they reply to
+      const resolved = typeof message.r === "object";
+      const replyMessage = resolved ? message.r : getMessageById(message.r);
+      const replyChannel = resolved ? message.r.c : getMessageChannel(message.r);
+      const replyUser = replyMessage ? getUser(replyMessage.u) : null;
+      const replyAvatar = replyUser && replyUser.avatar ? { id: replyMessage.u, path: replyUser.avatar } : null;
+      // Replies to messages of channels that are not loaded can still be jumped to, which loads the channel
+      obj["reply"] = replyMessage || replyChannel !== null ? {
+        "id": resolved ? message.r.id : message.r,
+        "channel": replyChannel,
+        "user": replyUser,
+        "avatar": replyAvatar,
+        "contents": replyMessage ? replyMessage.m : null
+      } : null;
+    }
+    if ("re" in message) {
+      obj["reactions"] = message.re;
+    }
+    return obj;
   };
   let eventOnUsersRefreshed;
   let eventOnChannelsRefreshed;
   let eventOnMessagesRefreshed;
+  let eventOnMessagesExtended;
+  let eventOnChannelBlockRequested;
   const triggerUsersRefreshed = function() {
     eventOnUsersRefreshed && eventOnUsersRefreshed(getUserList());
   };
@@ -1195,14 +3050,110 @@ var state_default = function() {
   const triggerMessagesRefreshed = function() {
     eventOnMessagesRefreshed && eventOnMessagesRefreshed(getMessageList());
   };
+  const triggerMessagesExtended = function(index) {
+    // The index is relative to the current page, like the message list
+    eventOnMessagesExtended && eventOnMessagesExtended(getMessageList(), Math.max(0, index - (messagesPerPage * (root.getCurrentPage() - 1) || 0)));
+  };
+  const isChannelSorted = function(channel) {
+    return channel in loadedFileKeys;
+  };
   const getFilteredMessageKeys = function(channel) {
     const messages = getMessages(channel);
-    let keys = Object.keys(messages);
+    if (filterFunction && searchCandidates) {
+      const keys = getIndexedMessageKeys(channel);
+      if (keys) {
+        return keys;
+      }
+    }
+    let keys = isChannelSorted(channel) ? loadedFileKeys[channel] : Object.keys(messages);
     if (filterFunction) {
       keys = keys.filter((key) => filterFunction(messages[key]));
     }
     return keys;
   };
+  // Messages of the search index that may contain the text of the contents filter, and message ids of channels sorted for looking them up
+  let searchCandidates = null;
+  const sortedKeys = /* @__PURE__ */ new Map();
+  const getIndexedMessageKeys = function(channel) {
+    // The search index numbers the messages of a channel in id order, so it is only used for channels that are fully loaded
+    const messages = getMessages(channel);
+    const count = search_default.getMessageCount(channel);
+    let keys = isChannelSorted(channel) ? loadedFileKeys[channel] : sortedKeys.get(channel);
+    if (!keys) {
+      keys = Object.keys(messages);
+      if (keys.length !== count) {
+        return null;
+      }
+      sortedKeys.set(channel, keys.sort(processor_default.SORTER.oldestToNewest));
+    }
+    if (keys.length !== count) {
+      return null;
+    }
+    const matches = [];
+    for (const position of searchCandidates.get(channel) || []) {
+      const key = keys[position];
+      if (filterFunction(messages[key])) {
+        matches.push(key);
+      }
+    }
+    return matches;
+  };
+  const loadChannelMessages = function(channel) {
+    const keys = getFilteredMessageKeys(channel);
+    loadedMessages = isChannelSorted(channel) ? keys : keys.sort(processor_default.SORTER.oldestToNewest);
+    if (filterFunction) {
+      filteredCounts.set(channel, keys.length);
+    }
+    extendedIndex = null;
+  };
+  // First index of the shown messages that changed since the last refresh, when batches were only added to them
+  let extendedIndex = null;
+  const extendLoadedMessages = function(channel, ids, sorted, previousLength) {
+    // The shown messages are extended in place, so the list keeps its scroll position and measured rows
+    if (loadedMessages === loadedFileKeys[channel]) {
+      extendedIndex = Math.min(extendedIndex ?? previousLength, previousLength);
+      return;
+    }
+    const messages = getMessages(channel);
+    const keys = filterFunction ? ids.filter((id) => filterFunction(messages[id])) : ids.slice();
+    if (keys.length === 0) {
+      return;
+    }
+    if (!sorted) {
+      keys.sort(processor_default.SORTER.oldestToNewest);
+    }
+    const last = loadedMessages.length - 1;
+    let index = loadedMessages.length;
+    if (last >= 0 && processor_default.SORTER.oldestToNewest(loadedMessages[last], keys[0]) > 0) {
+      index = findInsertIndex(loadedMessages, keys[0]);
+      loadedMessages = mergeMessageKeys(loadedMessages, keys);
+    } else {
+      loadedMessages.push(...keys);
+    }
+    extendedIndex = Math.min(extendedIndex ?? index, index);
+  };
+  const findInsertIndex = function(keys, id) {
+    let low = 0;
+    let high = keys.length;
+    while (low < high) {
+      const middle = low + high >>> 1;
+      if (processor_default.SORTER.oldestToNewest(keys[middle], id) < 0) {
+        low = middle + 1;
+      } else {
+        high = middle;
+      }
+    }
+    return low;
+  };
+  const mergeMessageKeys = function(keys1, keys2) {
+    const merged = new Array(keys1.length + keys2.length);
+    let i = 0;
+    let j = 0;
+    for (let k = 0; k < merged.length; k++) {
+      merged[k] = j >= keys2.length || i < keys1.length && processor_default.SORTER.oldestToNewest(keys1[i], keys2[j]) <= 0 ? keys1[i++] : keys2[j++];
+    }
+    return merged;
+  };
   const root = {
     onChannelsRefreshed(callback) {
       eventOnChannelsRefreshed = callback;
@@ -1210,10 +3161,16 @@ var state_default = function() {
     onMessagesRefreshed(callback) {
       eventOnMessagesRefreshed = callback;
     },
+    onMessagesExtended(callback) {
+      eventOnMessagesExtended = callback;
+    },
     onUsersRefreshed(callback) {
       eventOnUsersRefreshed = callback;
     },
-    uploadFile(meta, data) {
+    onChannelBlockRequested(callback) {
+      eventOnChannelBlockRequested = callback;
+    },
+    uploadFile(meta, data, keys) {
       if (loadedFileMeta != null) {
         throw "A file is already loaded!";
       }
@@ -1222,6 +3179,13 @@ var state_default = function() {
       }
       loadedFileMeta = meta;
       loadedFileData = data;
+      // Message ids of channels whose messages were loaded oldest to newest, which never have to be sorted
+      loadedFileKeys = keys || {};
+      // Channel of every message, so replies and jumps do not have to search every channel
+      loadedMessageChannels = /* @__PURE__ */ new Map();
+      for (const channel of Object.keys(data)) {
+        indexChannelMessages(channel);
+      }
       loadedMessages = null;
       selectedChannel = null;
       currentPage = 1;
@@ -1230,6 +3194,9 @@ var state_default = function() {
       triggerMessagesRefreshed();
       settings_default.onSettingsChanged(() => triggerMessagesRefreshed());
     },
+    resolveString(value) {
+      return typeof value === "number" ? loadedFileMeta.strings[value] : value;
+    },
     getChannelName(channel) {
       const channelObj = loadedFileMeta.channels[channel];
       return channelObj && channelObj.name || channel;
@@ -1242,10 +3209,69 @@ var state_default = function() {
       const userObj = loadedFileMeta.users[user];
       return userObj && (userObj.displayName || userObj.name) || user;
     },
+    addChannelMessages(channel, messages) {
+      const channelMessages = {};
+      const channelKeys = [];
+      for (const message of messages) {
+        channelMessages[message.id] = message;
+        channelKeys.push(message.id);
+        delete message.id;
+        delete message.c;
+      }
+      loadedFileData[channel] = channelMessages;
+      // Channel data files are written in message id order
+      loadedFileKeys[channel] = channelKeys;
+      indexChannelMessages(channel);
+      sortedKeys.delete(channel);
+      if (filterFunction) {
+        filteredCounts.set(channel, countFilteredMessages(channelMessages, channelKeys));
+      }
+    },
+    appendChannelMessages(channel, ids, messages, sorted) {
+      // Batches of the payload decoder, which arrive while the viewer is already in use
+      const channelMessages = loadedFileData[channel] || (loadedFileData[channel] = {});
+      const channelKeys = sorted ? loadedFileKeys[channel] || (loadedFileKeys[channel] = []) : null;
+      const previousLength = loadedMessages ? loadedMessages.length : 0;
+      for (let i = 0; i < ids.length; i++) {
+        channelMessages[ids[i]] = messages[i];
+        loadedMessageChannels.set(ids[i], channel);
+        channelKeys && channelKeys.push(ids[i]);
+      }
+      sortedKeys.delete(channel);
+      if (filterFunction) {
+        // A channel that is still waiting to be counted gets its full count later
+        filteredCounts.set(channel, (filteredCounts.get(channel) || 0) + countFilteredMessages(channelMessages, ids));
+      }
+      if (channel === selectedChannel && loadedMessages) {
+        extendLoadedMessages(channel, ids, sorted, previousLength);
+      }
+    },
+    refreshChannels(channels) {
+      triggerChannelsRefreshed(selectedChannel);
+      if (selectedChannel && channels.has(selectedChannel) && extendedIndex !== null) {
+        const index = extendedIndex;
+        extendedIndex = null;
+        triggerMessagesExtended(index);
+      }
+    },
     selectChannel(channel) {
       currentPage = 1;
       selectedChannel = channel;
-      loadedMessages = getFilteredMessageKeys(channel).sort(processor_default.SORTER.oldestToNewest);
+      if (isShardPending(channel)) {
+        loadedMessages = null;
+        triggerMessagesRefreshed();
+        loadShard(channel).then(() => {
+          if (selectedChannel === channel) {
+            root.selectChannel(channel);
+          }
+        }, (e) => {
+          console.error(e);
+          alert("Could not load channel, see console for details.");
+        });
+        return;
+      }
+      useShard(channel);
+      loadChannelMessages(channel);
       triggerMessagesRefreshed();
     },
     setMessagesPerPage(amount) {
@@ -1286,30 +3312,39 @@ var state_default = function() {
     getPageCount() {
       return !loadedMessages ? 0 : !messagesPerPage ? 1 : Math.ceil(loadedMessages.length / messagesPerPage);
     },
-    navigateToMessage(id) {
-      if (!loadedMessages) {
-        return -1;
+    /**
+     * Selects the channel of a message and the page it is on, loading the channel first if needed. The channel can be
+     * passed in for messages of channels that were never loaded. Resolves to the index of the message on the page, or -1.
+     */
+    navigateToMessage(id, channelHint) {
+      const channel = getMessageChannel(id) ?? channelHint ?? null;
+      if (channel !== null && isShardPending(channel)) {
+        return loadShard(channel).then(() => this.navigateToMessage(id, channel), (e) => {
+          console.error(e);
+          return -1;
+        });
       }
-      const channel = getMessageChannel(id);
       if (channel !== null && channel !== selectedChannel) {
         triggerChannelsRefreshed(channel);
         this.selectChannel(channel);
       }
-      const index = loadedMessages.indexOf(id);
+      const index = loadedMessages ? findMessageIndex(loadedMessages, id) : -1;
       if (index === -1) {
-        return -1;
+        return Promise.resolve(-1);
       }
       currentPage = Math.max(1, Math.min(this.getPageCount(), 1 + Math.floor(index / messagesPerPage)));
       triggerMessagesRefreshed();
-      return index % messagesPerPage;
+      return Promise.resolve(messagesPerPage ? index % messagesPerPage : index);
     },
     setActiveFilter(filter2) {
+      searchCandidates = null;
       switch (filter2 ? filter2.type : "") {
         case "user":
           filterFunction = processor_default.FILTER.byUser(filter2.value);
           break;
         case "contents":
           filterFunction = processor_default.FILTER.byContents(filter2.value);
+          searchCandidates = search_default.isLoaded() ? search_default.findCandidates(filter2.value) : null;
           break;
         case "withimages":
           filterFunction = processor_default.FILTER.withImages();
@@ -1325,6 +3360,7 @@ var state_default = function() {
           break;
       }
       this.hasActiveFilter = filterFunction != null;
+      startFilteredCounts();
       triggerChannelsRefreshed(selectedChannel);
       if (selectedChannel) {
         this.selectChannel(selectedChannel);
@@ -1485,7 +3521,7 @@ var discord_default = function() {
       ele.setAttribute("alt", "(image attachment not found)");
     },
     isImageAttachment(attachment) {
-      const url = dom_default.tryParseUrl(attachment.url);
+      const url = dom_default.tryParseUrl(state_default.resolveString(attachment.url));
       return url != null && isImageUrl(url);
     },
     getChannelHTML(channel) {
@@ -1546,10 +3582,14 @@ var discord_default = function() {
           if (!value) {
             return value === null ? "<span class='reply-contents reply-missing'>(replies to an unknown message)</span>" : "";
           }
+          const jump = "<span class='jump' data-jump='" + value.id + "'" + (value.channel ? " data-jump-channel='" + value.channel + "'" : "") + ">Jump to reply</span>";
+          if (!value.user) {
+            return jump + "<span class='reply-contents reply-missing'>(replies to a message in #" + state_default.getChannelName(value.channel) + ", which is not loaded)</span>";
+          }
           const user = "<span class='reply-username' title='" + value.user.name + "'>" + (value.user.displayName ?? value.user.name) + "</span>";
           const avatar = settings_default.enableUserAvatars && value.avatar ? "<span class='reply-avatar'>" + templateUserAvatar.apply(getAvatarUrlObject(value.avatar)) + "</span>" : "";
           const contents = value.contents ? "<span class='reply-contents'>" + processMessageContents(value.contents) + "</span>" : "";
-          return "<span class='jump' data-jump='" + value.id + "'>Jump to reply</span><span class='user'>" + avatar + user + "</span>" + contents;
+          return jump + "<span class='user'>" + avatar + user + "</span>" + contents;
         } else if (property === "reactions") {
           if (!value) {
             return "";
@@ -1574,6 +3614,121 @@ var gui_default = /* @__PURE__ */ function() {
   let eventOnOptMessagesPerPageChanged;
   let eventOnOptMessageFilterChanged;
   let eventOnNavButtonClicked;
+  // Virtual message list: only messages in or near the visible area are rendered, between
+  // two spacers that stand in for the rest. Row heights start out estimated and are measured
+  // as rows are rendered, summed in a Fenwick tree so the offset of a row and the row at an
+  // offset are both found in O(log n) however many messages there are.
+  const ESTIMATED_ROW_HEIGHT = 72;
+  const OVERSCAN_HEIGHT = 800;
+  let messageList = { length: 0, get: null };
+  let rowHeights = new Float64Array(0);
+  let rowTree = new Float64Array(1);
+  let renderedStart = 0;
+  let renderedEnd = 0;
+  let renderScheduled = false;
+  let rowObserver = null;
+  const resetRowHeights = function(count, keptHeights) {
+    rowHeights = new Float64Array(count).fill(ESTIMATED_ROW_HEIGHT);
+    if (keptHeights) {
+      rowHeights.set(keptHeights.subarray(0, Math.min(count, keptHeights.length)));
+    }
+    rowTree = new Float64Array(count + 1);
+    for (let i = 1; i <= count; i++) {
+      rowTree[i] += rowHeights[i - 1];
+      const parent = i + (i & -i);
+      if (parent <= count) {
+        rowTree[parent] += rowTree[i];
+      }
+    }
+  };
+  const setRowHeight = function(index, height) {
+    const delta = height - rowHeights[index];
+    rowHeights[index] = height;
+    for (let i = index + 1; i < rowTree.length; i += i & -i) {
+      rowTree[i] += delta;
+    }
+  };
+  const getRowOffset = function(index) {
+    let offset = 0;
+    for (let i = index; i > 0; i -= i & -i) {
+      offset += rowTree[i];
+    }
+    return offset;
+  };
+  const findRowAt = function(offset) {
+    let index = 0;
+    let step = 1;
+    while (step * 2 < rowTree.length) {
+      step *= 2;
+    }
+    for (; step > 0; step >>= 1) {
+      if (index + step < rowTree.length && rowTree[index + step] <= offset) {
+        index += step;
+        offset -= rowTree[index];
+      }
+    }
+    return Math.min(index, rowHeights.length - 1);
+  };
+  const scheduleMessageRender = function() {
+    if (!renderScheduled) {
+      renderScheduled = true;
+      requestAnimationFrame(renderMessageRows);
+    }
+  };
+  const renderMessageRows = function() {
+    renderScheduled = false;
+    const eleMessages = dom_default.id("messages");
+    const count = messageList.length;
+    if (count === 0) {
+      eleMessages.innerHTML = "";
+      renderedStart = renderedEnd = 0;
+      return;
+    }
+    const start = findRowAt(Math.max(0, eleMessages.scrollTop - OVERSCAN_HEIGHT));
+    const bottom = eleMessages.scrollTop + eleMessages.clientHeight + OVERSCAN_HEIGHT;
+    let end = start;
+    for (let offset = getRowOffset(start); end < count && offset < bottom; end++) {
+      offset += rowHeights[end];
+    }
+    if (start === renderedStart && end === renderedEnd) {
+      return;
+    }
+    const rows = [];
+    for (let i = start; i < end; i++) {
+      rows.push(discord_default.getMessageHTML(messageList.get(i)));
+    }
+    eleMessages.innerHTML = "<div class='virtual-spacer' style='height:" + getRowOffset(start) + "px'></div>" + rows.join("") + "<div class='virtual-spacer' style='height:" + (getRowOffset(count) - getRowOffset(end)) + "px'></div>";
+    renderedStart = start;
+    renderedEnd = end;
+    rowObserver.disconnect();
+    for (let i = 1; i <= end - start; i++) {
+      rowObserver.observe(eleMessages.children[i]);
+    }
+    measureMessageRows();
+  };
+  const measureMessageRows = function() {
+    // Rows change height when first laid out and when images load, the row at the top of the view is kept in place
+    const eleMessages = dom_default.id("messages");
+    const rows = eleMessages.children;
+    if (rows.length !== renderedEnd - renderedStart + 2) {
+      return;
+    }
+    const anchor = findRowAt(eleMessages.scrollTop);
+    const anchorOffset = eleMessages.scrollTop - getRowOffset(anchor);
+    let changed = false;
+    for (let i = renderedStart; i < renderedEnd; i++) {
+      const height = rows[i - renderedStart + 1].offsetHeight;
+      if (height !== rowHeights[i]) {
+        setRowHeight(i, height);
+        changed = true;
+      }
+    }
+    if (changed) {
+      rows[rows.length - 1].style.height = getRowOffset(messageList.length) - getRowOffset(renderedEnd) + "px";
+      eleMessages.scrollTop = getRowOffset(anchor) + anchorOffset;
+      scheduleMessageRender();
+    }
+  };
   const getActiveFilter = function() {
     const active = dom_default.fcls("active", dom_default.id("opt-filter-list"));
     return active && active.value !== "" ? {
@@ -1657,14 +3812,17 @@ var gui_default = /* @__PURE__ */ function() {
         const jump = e.target.getAttribute("data-jump");
         if (jump) {
           resetActiveFilter();
-          const index = state_default.navigateToMessage(jump);
-          if (index === -1) {
-            alert("Message not found.");
-          } else {
-            dom_default.id("messages").children[index].scrollIntoView();
-          }
+          state_default.navigateToMessage(jump, e.target.getAttribute("data-jump-channel")).then((index) => {
+            if (index === -1) {
+              alert("Message not found.");
+            } else {
+              this.scrollMessagesTo(index);
+            }
+          });
         }
       });
+      dom_default.id("messages").addEventListener("scroll", scheduleMessageRender);
+      rowObserver = new ResizeObserver(measureMessageRows);
       dom_default.id("overlay").addEventListener("click", () => {
         dom_default.id("modal").classList.remove("visible");
         dom_default.id("dialog").innerHTML = "";
@@ -1716,13 +3874,19 @@ var gui_default = /* @__PURE__ */ function() {
     /**
      * Updates the channel list and sets up their click events. The callback is triggered whenever a channel is selected, and takes the channel ID as its argument.
      */
+    /**
+     * Shows how much of the messages has been loaded, or hides it when given null.
+     */
+    updateLoadProgress(fraction) {
+      dom_default.id("load-progress").textContent = fraction === null ? "" : "Loading messages\u2026 " + Math.floor(fraction * 100) + "%";
+    },
     updateChannelList(channels, selected, callback) {
       const eleChannels = dom_default.id("channels");
       if (!channels) {
         eleChannels.innerHTML = "";
       } else {
         if (getActiveFilter() != null) {
-          channels = channels.filter((channel) => channel.msgcount > 0);
+          channels = channels.filter((channel) => channel.msgcount !== 0);
         }
         eleChannels.innerHTML = channels.map((channel) => discord_default.getChannelHTML(channel)).join("");
         Array.prototype.forEach.call(eleChannels.children, (ele) => {
@@ -1741,8 +3905,31 @@ var gui_default = /* @__PURE__ */ function() {
         }
       }
     },
+    /**
+     * Updates the message list, which is an object with the amount of messages as its length and a function that gets the message at an index.
+     */
     updateMessageList(messages) {
-      dom_default.id("messages").innerHTML = messages ? messages.map((message) => discord_default.getMessageHTML(message)).join("") : "";
+      messageList = messages || { length: 0, get: null };
+      resetRowHeights(messageList.length);
+      renderedStart = renderedEnd = -1;
+      renderMessageRows();
+    },
+    /**
+     * Updates the message list after messages were added to it, keeping the scroll position and the measured heights of the rows before the first changed index.
+     */
+    extendMessageList(messages, changedIndex) {
+      messageList = messages;
+      resetRowHeights(messageList.length, rowHeights.subarray(0, changedIndex));
+      if (changedIndex < renderedEnd) {
+        renderedStart = renderedEnd = -1;
+        renderMessageRows();
+      } else {
+        if (renderedEnd > 0) {
+          const rows = dom_default.id("messages").children;
+          rows[rows.length - 1].style.height = getRowOffset(messageList.length) - getRowOffset(renderedEnd) + "px";
+        }
+        scheduleMessageRender();
+      }
     },
     updateUserList(users) {
       const eleSelect = dom_default.id("opt-filter-user");
@@ -1761,7 +3948,15 @@ var gui_default = /* @__PURE__ */ function() {
       options.forEach((option) => eleSelect.add(option));
     },
     scrollMessagesToTop() {
-      dom_default.id("messages").scrollTop = 0;
+      this.scrollMessagesTo(0);
+    },
+    scrollMessagesTo(index) {
+      const eleMessages = dom_default.id("messages");
+      eleMessages.scrollTop = getRowOffset(index);
+      renderMessageRows();
+      // Rows above it may have been measured while rendering
+      eleMessages.scrollTop = getRowOffset(index);
+      scheduleMessageRender();
     }
   };
 }();
@@ -1801,6 +3996,7 @@ ReadableStream.prototype[Symbol.asyncIterator] ??= ReadableStream.prototype.valu
 
 // scripts/bootstrap.mjs
 window.DISCORD = discord_default;
+window.DHT_LOAD_SHARD = (channel, messages) => state_default.addChannelMessages(channel, messages);
 document.addEventListener("DOMContentLoaded", () => {
   discord_default.setup();
   gui_default.setup();
@@ -1825,8 +4021,16 @@ document.addEventListener("DOMContentLoaded", () => {
     gui_default.updateMessageList(messages);
     gui_default.scrollMessagesToTop();
   });
+  state_default.onMessagesExtended((messages, changedIndex) => {
+    gui_default.updateNavigation(state_default.getCurrentPage(), state_default.getPageCount());
+    gui_default.extendMessageList(messages, changedIndex);
+  });
   async function fetchUrl(path, contentType) {
-    const response = await fetch("/" + path + "?token=" + encodeURIComponent(window.DHT_SERVER_TOKEN) + "&session=" + encodeURIComponent(window.DHT_SERVER_SESSION), {
+    // Other parameters of the page, such as the channels and time range to browse, are passed on to the server
+    const query = new URLSearchParams(location.search);
+    query.set("token", window.DHT_SERVER_TOKEN);
+    query.set("session", window.DHT_SERVER_SESSION);
+    const response = await fetch("/" + path + "?" + query, {
       method: "GET",
       headers: {
         "Content-Type": contentType
@@ -1858,34 +4062,319 @@ document.addEventListener("DOMContentLoaded", () => {
       callback(body);
     }
   }
-  async function loadData() {
-    try {
-      // Parse metadata JSON
-      const metadataTag = document.getElementById("viewer-metadata");
-      const metadataJson = JSON.parse(metadataTag.textContent);
-
-      // Parse messages NDJSON
-      const messagesTag = document.getElementById("viewer-messages");
-      const rawNdjson = messagesTag.textContent.trim().split('\n');
-      const messages = {};
+  function decodePayload(request, post) {
+    // Runs inside the payload worker, whose source is built from this function, so it may only use its arguments
+    const { metadata, searchIndex, messages, payload, compression, batchSize } = request;
+    const encoder = new TextEncoder();
+    const postText = (message, text) => {
+      // Encoded text is transferred instead of copied, and parsed by the page a batch at a time
+      const buffer = encoder.encode(text).buffer;
+      post({ ...message, buffer }, [buffer]);
+    };
+    const decompress = async function*(base64, onProgress) {
+      // Decode base64 text a slice at a time, so the whole payload is never held as bytes twice
+      const sliceLength = 4 << 20;
+      let offset = 0;
+      const reader = new ReadableStream({
+        pull(controller) {
+          if (offset >= base64.length) {
+            controller.close();
+            return;
+          }
+          const binary = atob(base64.substring(offset, offset + sliceLength));
+          offset += sliceLength;
+          const bytes = new Uint8Array(binary.length);
+          for (let i = 0; i < binary.length; i++) {
+            bytes[i] = binary.charCodeAt(i);
+          }
+          controller.enqueue(bytes);
+          onProgress && onProgress(Math.min(offset, base64.length) / base64.length);
+        }
+      }).pipeThrough(new DecompressionStream(compression)).pipeThrough(new TextDecoderStream("utf-8")).getReader();
+      // Read explicitly, the worker does not get the ReadableStream async iterator polyfill of the page
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) {
+          return;
+        }
+        yield value;
+      }
+    };
+    const readLines = async function*(text) {
+      // Yields every line with the fraction of the payload read up to it
+      let body = "";
+      let done = 0;
+      const chunks = compression ? decompress(text.trim(), (fraction) => done = fraction) : [text];
+      for await (const chunk of chunks) {
+        body += chunk;
+        let startIndex = 0;
+        while (true) {
+          const endIndex = body.indexOf("\n", startIndex);
+          if (endIndex === -1) {
+            break;
+          }
+          yield [body.substring(startIndex, endIndex), compression ? done : endIndex / body.length];
+          startIndex = endIndex + 1;
+        }
+        body = body.substring(startIndex);
+      }
+      yield [body, 1];
+    };
 
-      for (const line of rawNdjson) {
-        if (!line.trim()) continue;
+    const linePrefix = /^\{"id":\s*"(\d+)",\s*"c":\s*"(\d+)",?\s*/;
+    const pending = new Map();
+    const flush = (channel) => {
+      const batch = pending.get(channel);
+      pending.delete(channel);
+      postText({ type: "batch", sorted: false }, '{"c":"' + channel + '","ids":' + JSON.stringify(batch.ids) + ',"messages":[' + batch.messages.join(",") + "]}");
+    };
+    const addMessage = (line) => {
+      // Messages are grouped by channel as text, cutting off their id and channel like generate_channel_ndjson()
+      const match = linePrefix.exec(line);
+      let id, channel, text;
+      if (match) {
+        [id, channel, text] = [match[1], match[2], "{" + line.substring(match[0].length)];
+      } else {
         const message = JSON.parse(line);
-        const channel = message.c;
-        const channelMessages = messages[channel] || (messages[channel] = {});
-        channelMessages[message.id] = message;
-
+        [id, channel] = [message.id, message.c];
         delete message.id;
         delete message.c;
+        text = JSON.stringify(message);
+      }
+      let batch = pending.get(channel);
+      if (!batch) {
+        pending.set(channel, batch = { ids: [], messages: [] });
+      }
+      batch.ids.push(id);
+      batch.messages.push(text);
+      if (batch.ids.length >= batchSize) {
+        flush(channel);
+      }
+    };
+    const decodeColumnarBlock = (block) => {
+      // Inverse of encode_columnar_block(), giving the messages of the block in id order
+      const count = block.id.length;
+      const list = new Array(count);
+      const ids = new Array(count);
+      let id = 0n;
+      let timestamp = 0;
+      for (let i = 0; i < count; i++) {
+        id += BigInt(block.id[i]);
+        timestamp += block.t[i];
+        ids[i] = String(id);
+        list[i] = { u: block.users[block.u[i]], t: timestamp };
+      }
+      for (const field of ["m", "a", "e", "te", "re", "r"]) {
+        const column = block[field];
+        if (!column) {
+          continue;
+        }
+        let index = 0;
+        for (let j = 0; j < column.i.length; j++) {
+          index += column.i[j];
+          list[index][field] = field === "te" ? list[index].t + column.v[j] : column.v[j];
+        }
+      }
+      return { c: block.c, ids, messages: list };
+    };
+
+    (async () => {
+      const readSection = async (text) => {
+        if (!compression) {
+          return text;
+        }
+        let result = "";
+        for await (const chunk of decompress(text.trim())) {
+          result += chunk;
+        }
+        return result;
+      };
+      if (metadata !== void 0) {
+        postText({ type: "metadata" }, await readSection(metadata));
+      }
+      if (searchIndex) {
+        postText({ type: "searchIndex" }, await readSection(searchIndex));
       }
 
-      state_default.uploadFile(metadataJson, messages);
+      let reported = 0;
+      for await (const [line, done] of readLines(messages)) {
+        if (line.trim()) {
+          if (payload === "channels") {
+            // Blocks of generate_channel_ndjson() are already batches of one channel in message id order
+            postText({ type: "batch", sorted: true }, line);
+          } else if (payload === "columnar") {
+            postText({ type: "batch", sorted: true }, JSON.stringify(decodeColumnarBlock(JSON.parse(line))));
+          } else {
+            addMessage(line);
+          }
+        }
+        if (done - reported >= 0.01) {
+          post({ type: "progress", done });
+          reported = done;
+        }
+      }
+      for (const channel of Array.from(pending.keys())) {
+        flush(channel);
+      }
+      post({ type: "done" });
+    })().catch((e) => post({ type: "error", error: String(e && e.stack || e) }));
+  }
+  function startPayloadDecoder(request, onMessage) {
+    // Decoding runs in a worker so the page stays usable while messages arrive, or in the page if workers cannot start
+    const decodeInPage = () => decodePayload(request, onMessage);
+    let worker;
+    let url;
+    try {
+      url = URL.createObjectURL(new Blob(["self.onmessage = (e) => (" + decodePayload + ")(e.data, (message, transfer) => self.postMessage(message, transfer));"], { type: "text/javascript" }));
+      worker = new Worker(url);
     } catch (e) {
+      url && URL.revokeObjectURL(url);
+      decodeInPage();
+      return;
+    }
+    let started = false;
+    worker.onmessage = (e) => {
+      if (!started) {
+        started = true;
+        URL.revokeObjectURL(url);
+      }
+      if (e.data.type === "done" || e.data.type === "error") {
+        worker.terminate();
+      }
+      onMessage(e.data);
+    };
+    worker.onerror = (e) => {
+      if (!started) {
+        e.preventDefault();
+        started = true;
+        URL.revokeObjectURL(url);
+        worker.terminate();
+        decodeInPage();
+      }
+    };
+    worker.postMessage(request);
+  }
+  function loadChannelBlock(id, addBatch) {
+    // Blocks of channels are decoded like the main payload, in a worker of their own
+    const tag = document.getElementById(id);
+    const decoder = new TextDecoder();
+    return new Promise((resolve, reject) => {
+      startPayloadDecoder({
+        messages: tag.textContent,
+        payload: document.getElementById("viewer-messages").dataset.payload || "ndjson",
+        compression: tag.dataset.compression || "",
+        batchSize: 5000
+      }, (message) => {
+        switch (message.type) {
+          case "batch":
+            const block = JSON.parse(decoder.decode(message.buffer));
+            addBatch(block.ids, block.messages);
+            break;
+          case "done":
+            resolve();
+            break;
+          case "error":
+            reject(message.error);
+            break;
+        }
+      });
+    });
+  }
+  state_default.onChannelBlockRequested(loadChannelBlock);
+  async function loadServerData(addBlock) {
+    // Pages of the serve command stream the metadata and channel blocks from the database instead of embedding them
+    const metadata = await (await fetchUrl("get-viewer-metadata", "application/json")).json();
+    state_default.uploadFile(metadata, {}, {});
+    let total = 0;
+    for (const channel of Object.values(metadata.channels)) {
+      total += channel.count || 0;
+    }
+    let loaded = 0;
+    await processLines(await fetchUrl("get-viewer-messages", "application/x-ndjson"), (line) => {
+      if (!line.trim()) {
+        return;
+      }
+      const block = JSON.parse(line);
+      addBlock(block, true);
+      loaded += block.ids.length;
+      gui_default.updateLoadProgress(total ? loaded / total : 0);
+    });
+  }
+  function loadData() {
+    const metadataTag = document.getElementById("viewer-metadata");
+    const messagesTag = document.getElementById("viewer-messages");
+    const decoder = new TextDecoder();
+    const updatedChannels = /* @__PURE__ */ new Set();
+    let refreshTimer = null;
+    let failed = false;
+
+    // Channel counts and the selected channel are refreshed at most a few times a second while batches arrive
+    const refresh = () => {
+      clearTimeout(refreshTimer);
+      refreshTimer = null;
+      state_default.refreshChannels(updatedChannels);
+      updatedChannels.clear();
+    };
+    const addBlock = (block, sorted) => {
+      state_default.appendChannelMessages(block.c, block.ids, block.messages, sorted);
+      updatedChannels.add(block.c);
+      refreshTimer = refreshTimer || setTimeout(refresh, 250);
+    };
+    const finish = () => {
+      refresh();
+      gui_default.updateLoadProgress(null);
+    };
+    const fail = (e) => {
+      failed = true;
       console.error(e);
       alert("Could not load data, see console for details.");
-      document.querySelector("#channels > div.loading").remove();
+      gui_default.updateLoadProgress(null);
+      const loading = document.querySelector("#channels > div.loading");
+      loading && loading.remove();
+    };
+
+    gui_default.updateLoadProgress(0);
+    if (window.DHT_SERVER_TOKEN) {
+      loadServerData(addBlock).then(finish, fail);
+      return;
     }
+    startPayloadDecoder({
+      metadata: metadataTag.textContent,
+      searchIndex: document.getElementById("viewer-search-index").textContent.trim(),
+      messages: messagesTag.textContent,
+      payload: messagesTag.dataset.payload || "ndjson",
+      compression: messagesTag.dataset.compression || "",
+      batchSize: 5000
+    }, (message) => {
+      if (failed) {
+        return;
+      }
+      try {
+        switch (message.type) {
+          case "metadata":
+            // The channel list is usable as soon as the metadata is in, before any messages
+            state_default.uploadFile(JSON.parse(decoder.decode(message.buffer)), {}, {});
+            break;
+          case "searchIndex":
+            search_default.load(JSON.parse(decoder.decode(message.buffer)));
+            break;
+          case "batch":
+            addBlock(JSON.parse(decoder.decode(message.buffer)), message.sorted);
+            break;
+          case "progress":
+            gui_default.updateLoadProgress(message.done);
+            break;
+          case "done":
+            finish();
+            break;
+          case "error":
+            fail(message.error);
+            break;
+        }
+      } catch (e) {
+        fail(e);
+      }
+    });
   }
   loadData();
 });